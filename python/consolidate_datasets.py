@@ -1,57 +1,149 @@
 from pathlib import Path
 from argparse import ArgumentParser
 
-import boto3
-import pandas as pd
-import zarr
-import numpy as np
-from tqdm.auto import tqdm
+from storage import get_backend
 
-from spikeinterface.core import Templates
+# Heavy dependencies are imported inside the functions that use them, so that other tools
+# (e.g. `delete_templates` and the `htl` command line) can import this module cheaply.
 
 parser = ArgumentParser(description="Consolidate datasets from spikeinterface template database")
 
 parser.add_argument("--dry-run", action="store_true", help="Dry run (no upload)")
 parser.add_argument("--verbose", action="store_true", help="Print additional information during processing")
 
+# The dataset shown by the web viewer: left out of `templates.csv`, but it gets its own preview sidecar
+viewer_dataset = "test_templates.zarr"
 
-def list_zarr_directories(bucket_name, boto_client=None) -> list[str]:
-    """Lists top-level Zarr directory keys in an S3 bucket.
+
+def open_template_dataset(zarr_path: str, storage_options: dict | None = None):
+    """Opens a template dataset stored either in the default (Zarr v2) or in the sharded (Zarr v3) layout.
+
+    Parameters
+    ----------
+    zarr_path : str
+        The path or URL of the Zarr dataset (e.g. "s3://bucket/dataset.zarr").
+    storage_options : dict, optional
+        Options passed to fsspec. Defaults to anonymous access for S3 URLs.
+
+    Returns
+    -------
+    zarr_group : zarr.Group
+        The dataset root group, opened read-only from its consolidated metadata.
+    """
+    import zarr
+
+    if storage_options is None:
+        storage_options = dict(anon=True) if zarr_path.startswith("s3://") else {}
+
+    # zarr >= 3 detects the Zarr format (v2 or v3) of the dataset from its metadata
+    return zarr.open_consolidated(zarr_path, mode="r", storage_options=storage_options or None)
+
+
+def audit_datasets(backend=None) -> list[dict]:
+    """Summarizes the objects of each top-level Zarr dataset in the template database, without opening the datasets.
 
     Parameters
     ----------
-    bucket_name : str
-        The name of the S3 bucket to search.
-    boto_client : boto3.client, optional
-        An existing Boto3 S3 client. If not provided, a new client will be created.
+    backend : S3Backend or LocalBackend, optional
+        The storage backend to audit. Defaults to the backend of the process (see `storage.get_backend`).
 
     Returns
     -------
-    zarr_directories : list
-        A list of strings representing the full S3 keys (paths) of top-level Zarr directories
-        found in the bucket.
+    audit : list of dict
+        One entry per dataset (sorted by name) with the keys "dataset", "layout" ("sharded" for Zarr v3 datasets,
+        "default" otherwise), "num_objects" and "size_bytes".
     """
+    backend = backend or get_backend()
+
+    audit = []
+    for dataset in sorted(backend.list_datasets()):
+        num_objects = 0
+        size_bytes = 0
+        layout = "default"
+        for key, size in backend.list_objects(f"{dataset}/"):
+            num_objects += 1
+            size_bytes += size
+            if key == f"{dataset}/zarr.json":
+                layout = "sharded"
+        audit.append(dict(dataset=dataset, layout=layout, num_objects=num_objects, size_bytes=size_bytes))
+
+    return audit
+
 
-    boto_client = boto_client or boto3.client("s3")
-    zarr_directories = set()
+def get_preview_units(zarr_group, templates, layout_index: int) -> list[dict]:
+    """Collects the preview sidecar fields of the units of a dataset (see `preview_sidecar.encode_preview_sidecar`).
 
-    paginator = boto_client.get_paginator("list_objects_v2")
-    for page in paginator.paginate(Bucket=bucket_name, Delimiter="/"):
-        for prefix in page.get("CommonPrefixes", []):
-            key = prefix["Prefix"]
-            if key.endswith(".zarr/"):
-                zarr_directories.add(key.rstrip("/"))
+    Parameters
+    ----------
+    zarr_group : zarr.Group
+        The dataset root group.
+    templates : spikeinterface.core.Templates
+        The templates of the dataset.
+    layout_index : int
+        The index of the channel layout of the dataset in the sidecar.
 
-    return list(zarr_directories)
+    Returns
+    -------
+    units : list of dict
+        One entry per unit of the dataset.
+    """
+    import numpy as np
+
+    from preview_sidecar import get_preview_active_channels
+    from zarr_utils import read_array
+
+    num_units = templates.num_units
+    template_indices = np.arange(num_units)
+    if "peak_to_peak" in zarr_group:
+        peak_to_peak = zarr_group["peak_to_peak"][:]
+    else:
+        peak_to_peak = np.ptp(templates.templates_array, axis=1)
+    if "best_channel_index" in zarr_group:
+        best_channel_indices = zarr_group["best_channel_index"][:]
+    else:
+        best_channel_indices = np.argmax(peak_to_peak, axis=1)
+    brain_areas = read_array(zarr_group["brain_area"]) if "brain_area" in zarr_group else ["unknown"] * num_units
+    spikes_per_unit = zarr_group["spikes_per_unit"][:]
+    peak_to_peak_best_channel = peak_to_peak[template_indices, best_channel_indices]
+    if "channel_noise_levels" in zarr_group:
+        noise_best_channel = zarr_group["channel_noise_levels"][best_channel_indices]
+        signal_to_noise_ratio_best_channel = peak_to_peak_best_channel / noise_best_channel
+    else:
+        signal_to_noise_ratio_best_channel = np.nan * np.zeros(num_units)
+
+    units = []
+    for unit_index in template_indices:
+        best_channel = best_channel_indices[unit_index]
+        active_channels = get_preview_active_channels(peak_to_peak[unit_index], best_channel)
+        units.append(
+            dict(
+                layout_index=layout_index,
+                best_channel=best_channel,
+                unit_id=templates.unit_ids[unit_index],
+                best_channel_id=templates.channel_ids[best_channel],
+                brain_area=brain_areas[unit_index],
+                spikes_per_unit=spikes_per_unit[unit_index],
+                amplitude_uv=peak_to_peak_best_channel[unit_index],
+                signal_to_noise_ratio=signal_to_noise_ratio_best_channel[unit_index],
+                nbefore=templates.nbefore,
+                sampling_frequency=templates.sampling_frequency,
+                active_channels=active_channels,
+                waveforms=templates.templates_array[unit_index][:, active_channels].T,
+            )
+        )
+    return units
 
 
 def consolidate_datasets(dry_run: bool = False, verbose: bool = False):
-    """Consolidates data from Zarr datasets within an S3 bucket.
+    """Consolidates data from Zarr datasets within the template database (see `storage.get_backend`).
+
+    Writes the `templates.csv` index, one preview sidecar per probe model (`previews/<probe model>.htlp`) and the
+    preview sidecar of the dataset shown by the web viewer (`previews/test_templates.htlp`, see `preview_sidecar.py`).
 
     Parameters
     ----------
     dry_run : bool, optional
-        If True, do not upload the consolidated data to S3. Defaults to False.
+        If True, do not upload the consolidated data to the template database. Defaults to False.
     verbose : bool, optional
         If True, print additional information during processing. Defaults to False.
 
@@ -65,29 +157,36 @@ def consolidate_datasets(dry_run: bool = False, verbose: bool = False):
     FileNotFoundError
         If no Zarr datasets are found in the specified bucket.
     """
+    import numpy as np
+    import pandas as pd
+    from tqdm.auto import tqdm
+
+    from spikeinterface.core import Templates
 
-    bucket = "spikeinterface-template-database"
-    boto_client = boto3.client("s3")
+    from preview_sidecar import encode_preview_sidecar, get_preview_file_name
+
+    backend = get_backend()
 
     # Get list of Zarr directories, excluding test datasets
-    zarr_datasets = list_zarr_directories(bucket_name=bucket, boto_client=boto_client)
-    datasets_to_avoid = ["test_templates.zarr"]
-    zarr_datasets = [d for d in zarr_datasets if d not in datasets_to_avoid]
+    existing_datasets = backend.list_datasets()
+    datasets_to_avoid = [viewer_dataset]
+    zarr_datasets = [d for d in existing_datasets if d not in datasets_to_avoid]
     zarr_datasets = sorted(zarr_datasets)
 
     if not zarr_datasets:
-        raise FileNotFoundError(f"No Zarr datasets found in bucket: {bucket}")
+        raise FileNotFoundError(f"No Zarr datasets found in bucket: {backend.bucket_name}")
     if verbose:
         print(f"Found {len(zarr_datasets)} datasets to consolidate\n")
 
-    # Initialize list to collect DataFrames for each dataset
+    # Initialize list to collect DataFrames for each dataset, and the preview sidecar content of each probe model
     all_dataframes = []
+    previews = {}
     desc = "Processing Zarr datasets"
     for dataset in tqdm(zarr_datasets, desc=desc, unit=" datasets processed", disable=not verbose):
         if verbose:
             print(f"Processing dataset: {dataset}")
-        zarr_path = f"s3://{bucket}/{dataset}"
-        zarr_group = zarr.open_consolidated(zarr_path, storage_options=dict(anon=True))
+        zarr_path = backend.get_url(dataset)
+        zarr_group = open_template_dataset(zarr_path, storage_options=backend.storage_options)
         templates = Templates.from_zarr_group(zarr_group)
 
         # Extract data efficiently using NumPy arrays
@@ -109,9 +208,22 @@ def consolidate_datasets(dry_run: bool = False, verbose: bool = False):
             noise_best_channel = zarr_group["channel_noise_levels"][best_channel_indices]
             signal_to_noise_ratio_best_channel = peak_to_peak_best_channel / noise_best_channel
 
+        # Datasets of the same probe model share the channel layouts of the sidecar
+        probe = probe_attributes["model_name"]
+        preview = previews.setdefault(probe, dict(channel_layouts=[], units=[]))
+        channel_locations = templates.get_channel_locations()[:, :2]
+        layout_indices = [i for i, layout in enumerate(preview["channel_layouts"]) if np.array_equal(layout, channel_locations)]
+        if layout_indices:
+            layout_index = layout_indices[0]
+        else:
+            layout_index = len(preview["channel_layouts"])
+            preview["channel_layouts"].append(channel_locations)
+        preview_indices = len(preview["units"]) + template_indices
+        preview["units"].extend(get_preview_units(zarr_group, templates, layout_index))
+
         new_entry = pd.DataFrame(
             {
-                "probe": [probe_attributes["model_name"]] * num_units,
+                "probe": [probe] * num_units,
                 "probe_manufacturer": [probe_attributes["manufacturer"]] * num_units,
                 "brain_area": brain_areas,
                 "depth_along_probe": depth_best_channel,
@@ -123,6 +235,7 @@ def consolidate_datasets(dry_run: bool = False, verbose: bool = False):
                 "spikes_per_unit": spikes_per_unit,
                 "dataset": [dataset] * num_units,
                 "dataset_path": [zarr_path] * num_units,
+                "preview_index": preview_indices,
             }
         )
 
@@ -136,15 +249,32 @@ def consolidate_datasets(dry_run: bool = False, verbose: bool = False):
     local_template_info_file_path = local_template_folder / templates_file_name
     templates_df.to_csv(local_template_info_file_path, index=False)
 
-    # Upload to S3
+    # The web viewer reads the rows of its dataset from a sidecar of its own, in the order of the dataset
+    if viewer_dataset in existing_datasets:
+        zarr_group = open_template_dataset(backend.get_url(viewer_dataset), storage_options=backend.storage_options)
+        templates = Templates.from_zarr_group(zarr_group)
+        previews[Path(viewer_dataset).stem] = dict(
+            channel_layouts=[templates.get_channel_locations()[:, :2]],
+            units=get_preview_units(zarr_group, templates, layout_index=0),
+        )
+
+    local_preview_folder = local_template_folder / "previews"
+    local_preview_folder.mkdir(parents=True, exist_ok=True)
+    local_preview_file_paths = []
+    for probe, preview in previews.items():
+        local_preview_file_path = local_preview_folder / get_preview_file_name(probe)
+        local_preview_file_path.write_bytes(encode_preview_sidecar(preview["channel_layouts"], preview["units"]))
+        local_preview_file_paths.append(local_preview_file_path)
+        if verbose:
+            print(f"Preview sidecar for {probe}: {len(preview['units'])} units, {local_preview_file_path.stat().st_size} bytes")
+
+    # Upload to the template database
     if dry_run:
         print("Dry run: skipping upload to S3")
     else:
-        boto_client.upload_file(
-            Filename=local_template_info_file_path,
-            Bucket=bucket,
-            Key=templates_file_name,
-        )
+        backend.upload_file(local_template_info_file_path, templates_file_name)
+        for local_preview_file_path in local_preview_file_paths:
+            backend.upload_file(local_preview_file_path, f"previews/{local_preview_file_path.name}")
 
     if verbose:
         print(templates_df)
@@ -1,37 +1,25 @@
-import boto3
 import numpy as np
 import zarr
 
-from consolidate_datasets import list_zarr_directories
+from incremental_upload import invalidate_manifest
+from storage import get_backend
+from zarr_utils import add_array, read_array, rewrite_array
 
 
-def delete_template_from_s3(bucket_name: str, template_key: str, boto_client: boto3.client = None) -> None:
-    """Deletes a Zarr template (and its contents) from S3."""
+def delete_dataset(dataset: str, backend=None) -> None:
+    """Deletes a Zarr dataset (and its contents) from the template database."""
+    backend = backend or get_backend()
 
-    boto_client = boto_client or boto3.client("s3")
-
-    # Delete all objects within the template directory (including nested directories)
-    boto_client.delete_objects(
-        Bucket=bucket_name,
-        Delete={
-            "Objects": [
-                {"Key": obj["Key"]}
-                for obj in boto_client.list_objects_v2(Bucket=bucket_name, Prefix=template_key).get("Contents", [])
-            ]
-        },
-    )
-    print(f"Deleted template: {template_key}")
+    # Delete all objects within the dataset directory (including nested directories)
+    backend.delete_prefix(f"{dataset.rstrip('/')}/")
+    print(f"Deleted template: {dataset}")
 
 
-def delete_templates_from_s3(
-    bucket_name: str,
-    template_keys: list[str],
-    boto_client: boto3.client = None,
-) -> None:
-    """Deletes multiple Zarr templates from S3."""
-    boto_client = boto_client or boto3.client("s3")
-    for key in template_keys:
-        delete_template_from_s3(bucket_name, key, boto_client=boto_client)
+def delete_datasets(datasets: list[str], backend=None) -> None:
+    """Deletes multiple Zarr datasets from the template database."""
+    backend = backend or get_backend()
+    for dataset in datasets:
+        delete_dataset(dataset, backend=backend)
 
 
 def delete_templates_too_few_spikes(min_spikes=50, dry_run=False, verbose=True):
@@ -41,16 +29,15 @@ def delete_templates_too_few_spikes(min_spikes=50, dry_run=False, verbose=True):
     The initial database was in fact created without a minimum number of spikes per unit,
     so some units have very few spikes and possibly a noisy template.
     """
-    import spikeinterface.generation as sgen
+    import pandas as pd
 
-    templates_info = sgen.fetch_templates_database_info()
+    backend = get_backend()
+    templates_info = pd.read_csv(backend.get_url("templates.csv"), storage_options=backend.storage_options)
     templates_to_remove = templates_info.query(f"spikes_per_unit < {min_spikes}")
 
     if len(templates_to_remove) > 0:
         if verbose:
-            print(
-                f"Removing {len(templates_to_remove)}/{len(templates_info)} templates with less than {min_spikes} spikes"
-            )
+            print(f"Removing {len(templates_to_remove)}/{len(templates_info)} templates with less than {min_spikes} spikes")
         datasets = np.unique(templates_to_remove["dataset"])
 
         for d_i, dataset in enumerate(datasets):
@@ -58,7 +45,6 @@ def delete_templates_too_few_spikes(min_spikes=50, dry_run=False, verbose=True):
                 print(f"\tCleaning dataset {d_i + 1}/{len(datasets)}")
             templates_in_dataset = templates_to_remove.query(f"dataset == '{dataset}'")
             template_indices_to_remove = templates_in_dataset.template_index.values
-            s3_path = templates_in_dataset.dataset_path.values[0]
 
             # to filter from the zarr dataset:
             datasets_to_filter = [
@@ -75,8 +61,8 @@ def delete_templates_too_few_spikes(min_spikes=50, dry_run=False, verbose=True):
                 mode = "r"
             else:
                 mode = "r+"
-            zarr_root = zarr.open(s3_path, mode=mode)
-            all_unit_indices = np.arange(len(zarr_root["unit_ids"]))
+            zarr_root = zarr.open(backend.get_mapper(dataset), mode=mode)
+            all_unit_indices = np.arange(zarr_root["unit_ids"].shape[0])
             n_original_units = len(all_unit_indices)
             unit_indices_to_keep = np.delete(all_unit_indices, template_indices_to_remove)
             n_units_to_keep = len(unit_indices_to_keep)
@@ -85,19 +71,21 @@ def delete_templates_too_few_spikes(min_spikes=50, dry_run=False, verbose=True):
             if verbose:
                 print(f"\tMax spikes to remove: {spikes_per_unit[template_indices_to_remove]}")
                 print(f"\tRemoving {n_original_units - n_units_to_keep} templates from {n_original_units}")
+            if not dry_run:
+                # The manifest must be gone before the first change, so the next sync_store compares actual keys
+                invalidate_manifest(backend.get_object_store(dataset))
             for dset in datasets_to_filter:
                 dataset_original = zarr_root[dset]
-                if len(dataset_original) == n_units_to_keep:
+                if dataset_original.shape[0] == n_units_to_keep:
                     if verbose:
                         print(f"\t\tDataset: {dset} - shape: {dataset_original.shape} - already updated")
                     continue
-                dataset_filtered = dataset_original[unit_indices_to_keep]
+                dataset_filtered = read_array(dataset_original)[unit_indices_to_keep]
                 if not dry_run:
                     if verbose:
                         print(f"\t\tUpdating: {dset} - shape: {dataset_filtered.shape}")
-                    if dataset_filtered.dtype.kind == "O":
-                        dataset_filtered = dataset_filtered.astype(str)
-                    zarr_root[dset] = dataset_filtered
+                    # keep the chunks and shards of the original array
+                    rewrite_array(zarr_root, dset, dataset_filtered)
                 else:
                     if verbose:
                         print(f"\t\tDry run: {dset} - shape: {dataset_filtered.shape}")
@@ -111,13 +99,12 @@ def restore_noise_levels_ibl(datasets, one=None, dry_run=False, verbose=True):
     """
     import spikeinterface as si
     import spikeinterface.extractors as se
-    import spikeinterface.generation as sgen
 
+    backend = get_backend()
     for dataset in datasets:
         if verbose:
             print(f"Processing dataset: {dataset}")
         pid = dataset.split("_")[-1][:-5]
-        dataset_path = f"s3://spikeinterface-template-database/{dataset}"
         recording = se.read_ibl_recording(pid=pid, load_sync_channel=False, stream_type="ap", one=one)
 
         default_params = si.get_default_analyzer_extension_params("noise_levels")
@@ -129,11 +116,15 @@ def restore_noise_levels_ibl(datasets, one=None, dry_run=False, verbose=True):
             mode = "r"
         else:
             mode = "r+"
-        zarr_root = zarr.open(dataset_path, mode=mode)
+        zarr_root = zarr.open(backend.get_mapper(dataset), mode=mode)
         if not dry_run:
             if verbose:
                 print(f"\tRestoring noise levels")
-            zarr_root["channel_noise_levels"] = noise_levels
+            invalidate_manifest(backend.get_object_store(dataset))
+            if "channel_noise_levels" in zarr_root:
+                rewrite_array(zarr_root, "channel_noise_levels", noise_levels)
+            else:
+                add_array(zarr_root, "channel_noise_levels", noise_levels, dtype="float32")
             zarr.consolidate_metadata(zarr_root.store)
         else:
             if verbose:
@@ -146,8 +137,7 @@ def delete_templates_with_num_samples(dry_run=False):
     This function will delete templates with number of samples,
     which were not corrected for in the initial database.
     """
-    bucket = "spikeinterface-template-database"
-    boto_client = boto3.client("s3")
+    backend = get_backend()
     verbose = True
 
     templates_to_erase_from_bucket = [
@@ -163,14 +153,12 @@ def delete_templates_with_num_samples(dry_run=False):
         "000409_sub-KS096_ses-a2701b93-d8e1-47e9-a819-f1063046f3e7_behavior+ecephys+image_f336f6a4-f693-4b88-b12c-c5cf0785b061.zarr",
         "000409_sub-KS096_ses-f819d499-8bf7-4da0-a431-15377a8319d5_behavior+ecephys+image_4ea45238-55b1-4d54-ba92-efa47feb9f57.zarr",
     ]
-    existing_templates = list_zarr_directories(bucket, boto_client=boto_client)
-    templates_to_erase_from_bucket = [
-        template for template in templates_to_erase_from_bucket if template in existing_templates
-    ]
+    existing_templates = backend.list_datasets()
+    templates_to_erase_from_bucket = [template for template in templates_to_erase_from_bucket if template in existing_templates]
     if dry_run:
         if verbose:
-            print(f"Would erase {len(templates_to_erase_from_bucket)} templates from bucket: {bucket}")
+            print(f"Would erase {len(templates_to_erase_from_bucket)} templates from bucket: {backend.bucket_name}")
     else:
         if verbose:
-            print(f"Erasing {len(templates_to_erase_from_bucket)} templates from bucket: {bucket}")
-        delete_templates_from_s3(bucket, templates_to_erase_from_bucket, boto_client=boto_client)
+            print(f"Erasing {len(templates_to_erase_from_bucket)} templates from bucket: {backend.bucket_name}")
+        delete_datasets(templates_to_erase_from_bucket, backend=backend)
@@ -0,0 +1,297 @@
+"""
+Command line entry point (`htl`) for the maintenance tools of the hybrid template library.
+
+Each subcommand imports its heavy dependencies (spikeinterface, pandas, zarr, boto3, ONE, DANDI, ...) only when
+it runs, so that `htl --help` and metadata-only subcommands start quickly.
+
+All subcommands access the template database through the storage backend of `storage.py` (the S3 bucket by
+default). With `--local-root`, they run offline against a local mirror created with `htl mirror`.
+
+Examples
+--------
+htl consolidate --dry-run --verbose
+htl audit
+htl --local-root ./mirror audit
+htl mirror ./mirror 000409_sub-KS084_[...].zarr
+htl delete datasets 000409_sub-KS084_[...].zarr --dry-run
+htl delete too-few-spikes --min-spikes 50
+htl ingest ibl --no-upload
+htl ingest ibl --sharded
+htl ingest ibl --pipelined --download-workers 2 --max-local-copies-gb 200
+htl shard --dry-run
+htl inject selected_templates.csv spike_schedule.npz --num-samples 1800000 --output injected.raw --n-jobs 8
+htl bank selected_templates.csv --num-shifts 10
+"""
+
+import sys
+from argparse import ArgumentParser
+from pathlib import Path
+
+
+def _add_common_arguments(parser, dry_run_help="Dry run (no changes to S3)"):
+    parser.add_argument("--dry-run", action="store_true", help=dry_run_help)
+    parser.add_argument("--verbose", action="store_true", help="Print additional information during processing")
+
+
+def run_consolidate(params):
+    from consolidate_datasets import consolidate_datasets
+
+    consolidate_datasets(dry_run=params.dry_run, verbose=params.verbose)
+
+
+def run_audit(params):
+    from consolidate_datasets import audit_datasets
+
+    audit = audit_datasets()
+    for entry in audit:
+        size_mb = entry["size_bytes"] / 1024**2
+        print(f"{entry['dataset']}\t{entry['layout']}\t{entry['num_objects']} objects\t{size_mb:.1f} MB")
+    if params.verbose:
+        num_objects = sum(entry["num_objects"] for entry in audit)
+        print(f"Total: {len(audit)} datasets, {num_objects} objects")
+
+
+def run_delete(params):
+    import delete_templates
+    from storage import get_backend
+
+    if params.target == "datasets":
+        if params.dry_run:
+            print(f"Would erase {len(params.datasets)} templates from bucket: {get_backend().bucket_name}")
+        else:
+            delete_templates.delete_datasets(params.datasets)
+    elif params.target == "too-few-spikes":
+        delete_templates.delete_templates_too_few_spikes(
+            min_spikes=params.min_spikes, dry_run=params.dry_run, verbose=params.verbose
+        )
+    elif params.target == "num-samples":
+        delete_templates.delete_templates_with_num_samples(dry_run=params.dry_run)
+
+
+def run_mirror(params):
+    from storage import LocalBackend, get_backend, mirror_datasets
+
+    mirror_datasets(
+        get_backend(),
+        LocalBackend(params.destination),
+        datasets=params.datasets or None,
+        include_index=not params.no_index,
+        verbose=True,
+    )
+
+
+def run_ingest(params):
+    if params.source == "ibl":
+        from upload_ibl_templates import upload_ibl_templates
+
+        upload_ibl_templates(
+            upload_data=not params.no_upload,
+            overwrite=params.overwrite,
+            do_testing_data=params.testing,
+            verbose=params.verbose,
+            pipelined=params.pipelined,
+            num_download_workers=params.download_workers,
+            num_compute_workers=params.compute_workers,
+            num_upload_workers=params.upload_workers,
+            min_free_disk_gb=params.min_free_disk_gb,
+            max_local_copies_gb=params.max_local_copies_gb,
+            sharded=params.sharded,
+            units_per_shard=params.units_per_shard,
+        )
+    elif params.source == "npultra":
+        from upload_npultra_templates import upload_npultra_templates
+
+        upload_npultra_templates(
+            params.path, upload_data=params.upload, sharded=params.sharded, units_per_shard=params.units_per_shard
+        )
+
+
+def run_shard(params):
+    from shard_datasets import migrate_datasets_to_sharded_layout
+
+    migrate_datasets_to_sharded_layout(
+        datasets=params.datasets or None,
+        units_per_shard=params.units_per_shard,
+        dry_run=params.dry_run,
+        verbose=params.verbose,
+    )
+
+
+def run_inject(params):
+    import numpy as np
+    import pandas as pd
+
+    from hybrid_injection import inject_templates, load_templates_from_index
+
+    templates_info = pd.read_csv(params.templates_info)
+    schedule = np.load(params.schedule)
+    amplitude_factors = schedule["amplitude_factors"] if "amplitude_factors" in schedule else None
+    if params.num_shifts is not None:
+        from template_bank import get_template_bank
+
+        templates_array, metadata = get_template_bank(
+            templates_info, params.num_shifts, cache_folder=params.cache_folder, verbose=params.verbose
+        )
+        nbefore, sampling_frequency = metadata["nbefore"], metadata["sampling_frequency"]
+        spike_shift_indices = schedule["spike_shift_indices"]
+    else:
+        templates_array, nbefore, sampling_frequency = load_templates_from_index(templates_info)
+        spike_shift_indices = None
+
+    output_path = inject_templates(
+        templates_array,
+        nbefore,
+        schedule["spike_samples"],
+        schedule["spike_unit_indices"],
+        num_samples=params.num_samples,
+        output_path=params.output,
+        amplitude_factors=amplitude_factors,
+        spike_shift_indices=spike_shift_indices,
+        output_format=params.format,
+        dtype=params.dtype,
+        background_file_path=params.background,
+        background_dtype=params.background_dtype,
+        chunk_size=params.chunk_size,
+        n_jobs=params.n_jobs,
+        active_channel_threshold=params.active_channel_threshold,
+    )
+    if params.verbose:
+        print(f"Injected {len(schedule['spike_samples'])} spikes at {sampling_frequency} Hz into {output_path}")
+
+
+def run_bank(params):
+    import pandas as pd
+
+    from template_bank import get_template_bank
+
+    templates_info = pd.read_csv(params.templates_info)
+    shifted_templates, metadata = get_template_bank(
+        templates_info, params.num_shifts, cache_folder=params.cache_folder, verbose=params.verbose
+    )
+    print(shifted_templates.filename)
+
+
+def get_parser():
+    parser = ArgumentParser(prog="htl", description="Maintenance tools for the spikeinterface hybrid template library")
+    parser.add_argument("--local-root", help="Use a local mirror of the template database instead of S3")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    consolidate_parser = subparsers.add_parser("consolidate", help="Consolidate datasets into the templates.csv index")
+    _add_common_arguments(consolidate_parser, dry_run_help="Dry run (no upload)")
+    consolidate_parser.set_defaults(func=run_consolidate)
+
+    audit_parser = subparsers.add_parser("audit", help="List datasets with their layout, object count and size")
+    audit_parser.add_argument("--verbose", action="store_true", help="Print totals over all datasets")
+    audit_parser.set_defaults(func=run_audit)
+
+    mirror_parser = subparsers.add_parser("mirror", help="Copy datasets and the templates.csv index to a local mirror")
+    mirror_parser.add_argument("destination", help="Root folder of the local mirror")
+    mirror_parser.add_argument("datasets", nargs="*", help="Datasets to copy (default: all datasets in the bucket)")
+    mirror_parser.add_argument("--no-index", action="store_true", help="Do not copy the templates.csv index")
+    mirror_parser.set_defaults(func=run_mirror)
+
+    delete_parser = subparsers.add_parser("delete", help="Delete datasets or templates from the database")
+    delete_subparsers = delete_parser.add_subparsers(dest="target", required=True)
+    delete_datasets_parser = delete_subparsers.add_parser("datasets", help="Delete whole datasets")
+    delete_datasets_parser.add_argument("datasets", nargs="+", help="Dataset keys to delete")
+    _add_common_arguments(delete_datasets_parser)
+    delete_few_spikes_parser = delete_subparsers.add_parser(
+        "too-few-spikes", help="Delete templates computed from too few spikes"
+    )
+    delete_few_spikes_parser.add_argument("--min-spikes", type=int, default=50, help="Minimum number of spikes")
+    _add_common_arguments(delete_few_spikes_parser)
+    delete_num_samples_parser = delete_subparsers.add_parser(
+        "num-samples", help="Delete datasets with a wrong number of samples"
+    )
+    _add_common_arguments(delete_num_samples_parser)
+    delete_parser.set_defaults(func=run_delete)
+
+    ingest_parser = subparsers.add_parser("ingest", help="Construct templates from a source and upload them")
+    ingest_subparsers = ingest_parser.add_subparsers(dest="source", required=True)
+    ingest_ibl_parser = ingest_subparsers.add_parser("ibl", help="IBL Brain Wide Map sessions from DANDI")
+    ingest_ibl_parser.add_argument("--no-upload", action="store_true", help="Save datasets locally in ./build")
+    ingest_ibl_parser.add_argument("--overwrite", action="store_true", help="Reprocess existing datasets")
+    ingest_ibl_parser.add_argument("--testing", action="store_true", help="Only process the test dataset")
+    ingest_ibl_parser.add_argument("--verbose", action="store_true", help="Print additional information")
+    ingest_ibl_parser.add_argument(
+        "--pipelined", action="store_true", help="Overlap the download, compute and upload of different sessions"
+    )
+    ingest_ibl_parser.add_argument("--download-workers", type=int, default=1, help="Concurrent downloads (pipelined)")
+    ingest_ibl_parser.add_argument("--compute-workers", type=int, default=1, help="Concurrent computations (pipelined)")
+    ingest_ibl_parser.add_argument("--upload-workers", type=int, default=1, help="Concurrent uploads (pipelined)")
+    ingest_ibl_parser.add_argument(
+        "--min-free-disk-gb", type=float, default=20, help="Free disk space to keep when copying recordings (pipelined)"
+    )
+    ingest_ibl_parser.add_argument(
+        "--max-local-copies-gb", type=float, help="Maximum total size of the local recording copies (pipelined)"
+    )
+    ingest_npultra_parser = ingest_subparsers.add_parser("npultra", help="Steinmetz and Ye 2022 NP Ultra templates")
+    ingest_npultra_parser.add_argument("path", help="Folder with the NP Ultra files downloaded from Figshare")
+    ingest_npultra_parser.add_argument("--upload", action="store_true", help="Upload datasets to S3")
+    for source_parser in (ingest_ibl_parser, ingest_npultra_parser):
+        source_parser.add_argument("--sharded", action="store_true", help="Write datasets in the sharded layout")
+        source_parser.add_argument("--units-per-shard", type=int, default=64, help="Number of unit chunks per shard")
+    ingest_parser.set_defaults(func=run_ingest)
+
+    shard_parser = subparsers.add_parser("shard", help="Migrate datasets to the sharded Zarr layout")
+    shard_parser.add_argument(
+        "datasets", nargs="*", help="Datasets to migrate (default: all datasets except test_templates.zarr)"
+    )
+    shard_parser.add_argument("--units-per-shard", type=int, default=64, help="Number of unit chunks per shard")
+    _add_common_arguments(shard_parser, dry_run_help="Dry run (only re-encode and verify in memory)")
+    shard_parser.set_defaults(func=run_shard)
+
+    inject_parser = subparsers.add_parser("inject", help="Render hybrid traces from library templates")
+    inject_parser.add_argument("templates_info", help="CSV with the selected rows of the templates index")
+    inject_parser.add_argument(
+        "schedule", help="NPZ with spike_samples, spike_unit_indices (rows of templates_info) and amplitude_factors"
+    )
+    inject_parser.add_argument("--num-samples", type=int, required=True, help="Number of samples of the output")
+    inject_parser.add_argument("--output", required=True, help="Output binary file or Zarr array")
+    inject_parser.add_argument("--format", choices=["binary", "zarr"], default="binary", help="Output format")
+    inject_parser.add_argument("--dtype", default="float32", help="Output dtype")
+    inject_parser.add_argument("--background", help="Binary file (samples x channels) to inject the templates into")
+    inject_parser.add_argument("--background-dtype", default="float32", help="Dtype of the background file")
+    inject_parser.add_argument("--chunk-size", type=int, default=30_000, help="Number of samples per chunk")
+    inject_parser.add_argument("--n-jobs", type=int, default=1, help="Number of worker processes (0 or negative: one per CPU)")
+    inject_parser.add_argument(
+        "--active-channel-threshold",
+        type=float,
+        default=0.01,
+        help="Fraction of the best channel's peak-to-peak below which template channels are not injected",
+    )
+    inject_parser.add_argument(
+        "--num-shifts", type=int, help="Use a bank of sub-sample-shifted templates (schedule needs spike_shift_indices)"
+    )
+    inject_parser.add_argument("--cache-folder", help="Template bank cache folder (default: ./build/template_banks)")
+    inject_parser.add_argument("--verbose", action="store_true", help="Print additional information")
+    inject_parser.set_defaults(func=run_inject)
+
+    bank_parser = subparsers.add_parser("bank", help="Precompute and cache a bank of sub-sample-shifted templates")
+    bank_parser.add_argument("templates_info", help="CSV with the selected rows of the templates index")
+    bank_parser.add_argument("--num-shifts", type=int, required=True, help="Number of sub-sample shifts per template")
+    bank_parser.add_argument("--cache-folder", help="Template bank cache folder (default: ./build/template_banks)")
+    bank_parser.add_argument("--verbose", action="store_true", help="Print additional information")
+    bank_parser.set_defaults(func=run_bank)
+
+    return parser
+
+
+def main(argv=None):
+    params = get_parser().parse_args(argv)
+
+    # The maintenance scripts import each other as top-level modules (they are meant to be run from this folder)
+    scripts_folder = str(Path(__file__).parent)
+    if scripts_folder not in sys.path:
+        sys.path.insert(0, scripts_folder)
+
+    if params.local_root is not None:
+        from storage import LocalBackend, set_backend
+
+        set_backend(LocalBackend(params.local_root))
+
+    params.func(params)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,387 @@
+"""
+Chunked, multi-worker injection of library templates into hybrid recordings.
+
+Templates are selected from the consolidated index (`templates.csv`, see `consolidate_datasets.py`) and injected
+according to a spike schedule (spike sample indices and the index of the injected template for each spike).
+Traces are rendered chunk by chunk, optionally on a pool of worker processes, and streamed to a binary file or to
+a Zarr array so that memory usage is bounded by the number of chunks in flight, independently of the recording
+duration.
+
+Templates can also be served from a bank of sub-sample-shifted templates (see `template_bank.py`), in which case
+each spike also selects one of the shifted versions of its template. Memory-mapped `.npy` templates or banks are
+opened by each worker from their file, so that workers share one copy through the page cache.
+
+Within a chunk, spikes are grouped by unit and added with a vectorized scatter-add restricted to the active
+channels of each template. Spikes whose waveform straddles a chunk border are rendered in both chunks, each chunk
+receiving the samples that fall within its boundaries.
+"""
+
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+# Channels whose peak-to-peak is below this fraction of the best channel's are not injected
+default_active_channel_threshold = 0.01
+
+# Templates and injection parameters shared by the worker processes (set by `_init_worker`)
+_worker_context = {}
+
+
+def load_templates_from_index(templates_info):
+    """Loads the templates selected from the consolidated templates index.
+
+    Parameters
+    ----------
+    templates_info : pandas.DataFrame
+        Rows of the templates index (as returned by `consolidate_datasets` or
+        `spikeinterface.generation.fetch_templates_database_info`). The "dataset_path" and "template_index"
+        columns are used.
+
+    Returns
+    -------
+    templates_array : np.ndarray
+        The templates, with shape (num_units, num_samples, num_channels), in the order of the rows of
+        `templates_info`.
+    nbefore : int
+        The number of samples before the peak in each template.
+    sampling_frequency : float
+        The sampling frequency of the templates.
+
+    Raises
+    ------
+    ValueError
+        If the selected templates differ in sampling frequency, number of samples or number of channels.
+    """
+    from consolidate_datasets import open_template_dataset
+
+    dataset_paths = np.asarray(templates_info["dataset_path"])
+    template_indices = np.asarray(templates_info["template_index"], dtype="int64")
+
+    templates_array = None
+    nbefore = None
+    sampling_frequency = None
+    for dataset_path in dict.fromkeys(dataset_paths):
+        rows = np.flatnonzero(dataset_paths == dataset_path)
+        zarr_group = open_template_dataset(dataset_path)
+        dataset_templates = zarr_group["templates_array"].get_orthogonal_selection(
+            (template_indices[rows], slice(None), slice(None))
+        )
+
+        dataset_nbefore = int(zarr_group.attrs["nbefore"])
+        dataset_sampling_frequency = float(zarr_group.attrs["sampling_frequency"])
+
+        if templates_array is None:
+            templates_array = np.zeros((len(template_indices),) + dataset_templates.shape[1:], dtype="float32")
+            nbefore = dataset_nbefore
+            sampling_frequency = dataset_sampling_frequency
+        elif dataset_templates.shape[1:] != templates_array.shape[1:]:
+            raise ValueError(
+                f"Templates from {dataset_path} have shape {dataset_templates.shape[1:]}, "
+                f"expected {templates_array.shape[1:]} (num_samples, num_channels)"
+            )
+        elif dataset_nbefore != nbefore or dataset_sampling_frequency != sampling_frequency:
+            raise ValueError(f"Templates from {dataset_path} have a different nbefore or sampling frequency")
+
+        templates_array[rows] = dataset_templates
+
+    return templates_array, nbefore, sampling_frequency
+
+
+def get_active_channels(templates_array, active_channel_threshold=default_active_channel_threshold):
+    """Returns, for each template, the indices of the channels with a peak-to-peak above a relative threshold.
+
+    Parameters
+    ----------
+    templates_array : np.ndarray
+        The templates, with shape (num_units, num_samples, num_channels).
+    active_channel_threshold : float, default: 0.01
+        Fraction of the peak-to-peak on the best channel below which a channel is considered silent. The samples
+        of silent channels are not injected, so each injected sample differs from the full template by less than
+        this fraction of the best channel's peak-to-peak. With 0.0, only channels that are exactly flat are dropped.
+
+    Returns
+    -------
+    active_channels : list of np.ndarray
+        The active channel indices of each template.
+    """
+    peak_to_peak = np.ptp(templates_array, axis=1)
+    max_peak_to_peak = peak_to_peak.max(axis=1, keepdims=True)
+    active_mask = (peak_to_peak > active_channel_threshold * max_peak_to_peak) & (max_peak_to_peak > 0)
+    return [np.flatnonzero(mask) for mask in active_mask]
+
+
+def render_chunk(
+    start_frame,
+    end_frame,
+    spike_samples,
+    spike_unit_indices,
+    amplitude_factors,
+    templates_array,
+    active_channels,
+    nbefore,
+    background=None,
+    spike_shift_indices=None,
+):
+    """Renders the injected traces between `start_frame` and `end_frame`.
+
+    `spike_samples`, `spike_unit_indices`, `amplitude_factors` (and `spike_shift_indices`) hold the spikes whose
+    waveform overlaps the chunk (spikes straddling the chunk borders included). Samples falling outside the chunk
+    are dropped. If `spike_shift_indices` is given, `templates_array` is a bank of shifted templates with shape
+    (num_units, num_shifts, num_samples, num_channels).
+
+    Returns
+    -------
+    traces : np.ndarray
+        The rendered traces (float32), with shape (end_frame - start_frame, num_channels).
+    """
+    num_frames = end_frame - start_frame
+    num_channels = templates_array.shape[-1]
+    if background is not None:
+        traces = np.array(background[start_frame:end_frame], dtype="float32")
+    else:
+        traces = np.zeros((num_frames, num_channels), dtype="float32")
+
+    if len(spike_samples) == 0:
+        return traces
+
+    template_offsets = np.arange(templates_array.shape[-2]) - nbefore
+    if spike_shift_indices is None:
+        num_shifts = 1
+        spike_template_keys = spike_unit_indices
+    else:
+        num_shifts = templates_array.shape[1]
+        spike_template_keys = spike_unit_indices * num_shifts + spike_shift_indices
+
+    order = np.argsort(spike_template_keys, kind="stable")
+    template_keys, key_starts = np.unique(spike_template_keys[order], return_index=True)
+    for template_key, spike_indices in zip(template_keys, np.split(order, key_starts[1:])):
+        unit_index, shift_index = divmod(template_key, num_shifts)
+        channels = active_channels[unit_index]
+        if len(channels) == 0:
+            continue
+        template = templates_array[unit_index] if spike_shift_indices is None else templates_array[unit_index, shift_index]
+        waveform = np.asarray(template[:, channels], dtype="float32")
+
+        # (num_spikes, num_template_samples) positions of each template sample within the chunk
+        positions = (spike_samples[spike_indices] - start_frame)[:, None] + template_offsets[None, :]
+        valid = (positions >= 0) & (positions < num_frames)
+        values = waveform[None, :, :] * amplitude_factors[spike_indices, None, None]
+
+        # np.add.at accumulates repeated indices, so overlapping spikes of the same unit add up
+        np.add.at(traces, (positions[valid][:, None], channels[None, :]), values[valid])
+
+    return traces
+
+
+def _init_worker(templates, active_channels, nbefore, background_kwargs):
+    if isinstance(templates, (str, Path)):
+        templates = np.load(templates, mmap_mode="r")
+    _worker_context["templates_array"] = templates
+    _worker_context["active_channels"] = active_channels
+    _worker_context["nbefore"] = nbefore
+    _worker_context["background"] = _open_background(**background_kwargs) if background_kwargs else None
+
+
+def _render_chunk_in_worker(start_frame, end_frame, spike_samples, spike_unit_indices, amplitude_factors, spike_shift_indices):
+    return render_chunk(
+        start_frame,
+        end_frame,
+        spike_samples,
+        spike_unit_indices,
+        amplitude_factors,
+        _worker_context["templates_array"],
+        _worker_context["active_channels"],
+        _worker_context["nbefore"],
+        background=_worker_context["background"],
+        spike_shift_indices=spike_shift_indices,
+    )
+
+
+def _open_background(file_path, dtype, num_channels):
+    return np.memmap(file_path, dtype=dtype, mode="r").reshape(-1, num_channels)
+
+
+def inject_templates(
+    templates_array,
+    nbefore,
+    spike_samples,
+    spike_unit_indices,
+    num_samples,
+    output_path,
+    amplitude_factors=None,
+    spike_shift_indices=None,
+    output_format="binary",
+    dtype="float32",
+    background_file_path=None,
+    background_dtype="float32",
+    chunk_size=30_000,
+    n_jobs=1,
+    max_chunks_in_flight=None,
+    active_channel_threshold=default_active_channel_threshold,
+):
+    """Renders the injected traces chunk by chunk and streams them to a binary file or to a Zarr array.
+
+    Parameters
+    ----------
+    templates_array : np.ndarray
+        The templates to inject, with shape (num_units, num_template_samples, num_channels), e.g. from
+        `load_templates_from_index`, or a bank of shifted templates with shape
+        (num_units, num_shifts, num_template_samples, num_channels) from `template_bank.get_template_bank`.
+        Memory-mapped `.npy` arrays are opened from their file by each worker instead of being copied.
+    nbefore : int
+        The number of samples before the peak in each template.
+    spike_samples : np.ndarray
+        The sample index of the peak of each injected spike.
+    spike_unit_indices : np.ndarray
+        The index (in `templates_array`) of the template injected for each spike.
+    num_samples : int
+        The number of samples of the output traces.
+    output_path : str or Path
+        The output binary file or Zarr array.
+    amplitude_factors : np.ndarray, optional
+        A scaling factor for each spike. Defaults to 1.
+    spike_shift_indices : np.ndarray, optional
+        For a bank of shifted templates, the shift index of each spike. Required if `templates_array` is a bank.
+    output_format : "binary" | "zarr", default: "binary"
+        The output format. Binary files are written in C order (samples x channels) without a header.
+    dtype : str, default: "float32"
+        The dtype of the output traces.
+    background_file_path : str or Path, optional
+        A binary file (samples x channels) with the traces to inject the templates into, e.g. the parent
+        recording of a hybrid recording. If None, only the injected templates are rendered.
+    background_dtype : str, default: "float32"
+        The dtype of the background file.
+    chunk_size : int, default: 30000
+        The number of samples rendered per chunk.
+    n_jobs : int, default: 1
+        The number of worker processes. With 1, chunks are rendered in the current process. With 0 or a negative
+        value, one worker per CPU is used.
+    max_chunks_in_flight : int, optional
+        The maximum number of chunks rendered but not yet written, which bounds memory usage.
+        Defaults to 2 * n_jobs.
+    active_channel_threshold : float, default: 0.01
+        See `get_active_channels`.
+
+    Returns
+    -------
+    output_path : Path
+        The path of the written traces.
+
+    Raises
+    ------
+    ValueError
+        If the spike schedule is inconsistent with the templates, or the background is shorter than `num_samples`.
+    """
+    num_units, template_length, num_channels = templates_array.shape[0], templates_array.shape[-2], templates_array.shape[-1]
+    if (templates_array.ndim == 4) != (spike_shift_indices is not None):
+        raise ValueError("spike_shift_indices must be given if and only if templates_array is a bank of shifted templates")
+    spike_samples = np.asarray(spike_samples, dtype="int64")
+    spike_unit_indices = np.asarray(spike_unit_indices, dtype="int64")
+    if amplitude_factors is None:
+        amplitude_factors = np.ones(len(spike_samples), dtype="float32")
+    amplitude_factors = np.asarray(amplitude_factors, dtype="float32")
+    if not len(spike_samples) == len(spike_unit_indices) == len(amplitude_factors):
+        raise ValueError("spike_samples, spike_unit_indices and amplitude_factors must have the same length")
+    if len(spike_unit_indices) > 0 and not (0 <= spike_unit_indices.min() and spike_unit_indices.max() < num_units):
+        raise ValueError(f"spike_unit_indices must be between 0 and {num_units - 1}")
+    if spike_shift_indices is not None:
+        spike_shift_indices = np.asarray(spike_shift_indices, dtype="int64")
+        if len(spike_shift_indices) != len(spike_samples):
+            raise ValueError("spike_shift_indices must have the same length as spike_samples")
+        if len(spike_shift_indices) > 0 and not (
+            0 <= spike_shift_indices.min() and spike_shift_indices.max() < templates_array.shape[1]
+        ):
+            raise ValueError(f"spike_shift_indices must be between 0 and {templates_array.shape[1] - 1}")
+    if output_format not in ("binary", "zarr"):
+        raise ValueError(f"output_format must be 'binary' or 'zarr', not {output_format}")
+    if background_file_path is not None:
+        background_num_samples = Path(background_file_path).stat().st_size // (
+            np.dtype(background_dtype).itemsize * num_channels
+        )
+        if background_num_samples < num_samples:
+            raise ValueError(
+                f"The background has {background_num_samples} samples of {num_channels} channels, "
+                f"fewer than num_samples={num_samples}"
+            )
+    if n_jobs <= 0:
+        n_jobs = os.cpu_count() or 1
+
+    order = np.argsort(spike_samples, kind="stable")
+    spike_samples = spike_samples[order]
+    spike_unit_indices = spike_unit_indices[order]
+    amplitude_factors = amplitude_factors[order]
+    if spike_shift_indices is not None:
+        spike_shift_indices = spike_shift_indices[order]
+
+    unshifted_templates = templates_array if templates_array.ndim == 3 else templates_array[:, 0]
+    active_channels = get_active_channels(unshifted_templates, active_channel_threshold=active_channel_threshold)
+    templates = templates_array
+    if isinstance(templates_array, np.memmap) and str(templates_array.filename).endswith(".npy"):
+        templates = templates_array.filename
+    background_kwargs = None
+    if background_file_path is not None:
+        background_kwargs = dict(file_path=background_file_path, dtype=background_dtype, num_channels=num_channels)
+
+    output_path = Path(output_path)
+    if output_format == "binary":
+        output = open(output_path, "wb")
+        write_chunk = lambda start_frame, traces: output.write(traces.astype(dtype, copy=False).tobytes())
+    else:
+        import zarr
+
+        output = zarr.open_array(
+            str(output_path), mode="w", shape=(num_samples, num_channels), chunks=(chunk_size, num_channels), dtype=dtype
+        )
+        write_chunk = lambda start_frame, traces: output.__setitem__(
+            slice(start_frame, start_frame + traces.shape[0]), traces.astype(dtype, copy=False)
+        )
+
+    def chunk_arguments(start_frame):
+        end_frame = min(start_frame + chunk_size, num_samples)
+        # A spike at sample s covers [s - nbefore, s - nbefore + template_length)
+        first = np.searchsorted(spike_samples, start_frame + nbefore - template_length, side="right")
+        last = np.searchsorted(spike_samples, end_frame + nbefore, side="left")
+        spikes = slice(first, last)
+        shift_indices = spike_shift_indices[spikes] if spike_shift_indices is not None else None
+        return (
+            start_frame,
+            end_frame,
+            spike_samples[spikes],
+            spike_unit_indices[spikes],
+            amplitude_factors[spikes],
+            shift_indices,
+        )
+
+    chunk_starts = range(0, num_samples, chunk_size)
+    try:
+        if n_jobs == 1:
+            _init_worker(templates, active_channels, nbefore, background_kwargs)
+            for start_frame in chunk_starts:
+                write_chunk(start_frame, _render_chunk_in_worker(*chunk_arguments(start_frame)))
+        else:
+            max_chunks_in_flight = max_chunks_in_flight or 2 * n_jobs
+            with ProcessPoolExecutor(
+                max_workers=n_jobs,
+                initializer=_init_worker,
+                initargs=(templates, active_channels, nbefore, background_kwargs),
+            ) as executor:
+                # Chunks are written in order: wait for the oldest chunk when the window is full
+                futures = deque()
+                for start_frame in chunk_starts:
+                    if len(futures) >= max_chunks_in_flight:
+                        oldest_start_frame, future = futures.popleft()
+                        write_chunk(oldest_start_frame, future.result())
+                    arguments = chunk_arguments(start_frame)
+                    futures.append((start_frame, executor.submit(_render_chunk_in_worker, *arguments)))
+                while futures:
+                    oldest_start_frame, future = futures.popleft()
+                    write_chunk(oldest_start_frame, future.result())
+    finally:
+        _worker_context.clear()
+        if output_format == "binary":
+            output.close()
+
+    return output_path
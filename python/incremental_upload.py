@@ -0,0 +1,162 @@
+"""
+Incremental upload of Zarr datasets based on per-chunk content hashes.
+
+Datasets are first written to an in-memory staging store (a plain dictionary of encoded Zarr keys). The SHA-256
+hash of every key is compared with a manifest stored with the dataset (`.htl_manifest.json`), and only the keys
+whose content changed are transmitted. Re-running an upload with identical parameters therefore transmits nothing,
+and partial recomputes (e.g. only `channel_noise_levels`) only transmit the affected chunks.
+
+Keys are transmitted in an order that keeps the dataset readable at all times: chunks first, then array and group
+metadata, then the consolidated metadata (`.zmetadata`, or the root `zarr.json` of Zarr v3 datasets), and the manifest
+last. Keys that no longer exist in the staging store are deleted. Within each of these groups, keys are transmitted
+concurrently with a bounded number of writes in flight, and each group is only started once all the writes of the
+previous group are confirmed, so readers never see consolidated metadata that refers to missing chunks. With the
+`storage.ObjectStore` of a backend as destination, large keys (e.g. shards) are written with multipart uploads.
+
+Tools that modify a dataset in place without going through `sync_store` must call `invalidate_manifest`.
+"""
+
+import hashlib
+import json
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+manifest_key = ".htl_manifest.json"
+manifest_version = 1
+
+_metadata_keys = (".zarray", ".zattrs", ".zgroup", "zarr.json")
+_consolidated_metadata_key = ".zmetadata"
+
+
+def _to_bytes(value) -> bytes:
+    # zarr 2 stores hold bytes, zarr 3 memory stores hold Buffer objects
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return bytes(value)
+    return value.to_bytes()
+
+
+def compute_store_manifest(store) -> dict:
+    """Computes the SHA-256 hash of the content of every key of a store.
+
+    Parameters
+    ----------
+    store : MutableMapping
+        The store to hash, typically the in-memory staging store of a dataset.
+
+    Returns
+    -------
+    hashes : dict
+        The hexadecimal SHA-256 digest of each key (the manifest key itself excluded).
+    """
+    return {key: hashlib.sha256(_to_bytes(store[key])).hexdigest() for key in store if key != manifest_key}
+
+
+def load_manifest(store) -> dict | None:
+    """Loads the chunk hashes of the manifest stored with a dataset, or None if the dataset has no manifest."""
+    try:
+        manifest = json.loads(_to_bytes(store[manifest_key]))
+    except KeyError:
+        return None
+    if manifest.get("version") != manifest_version:
+        return None
+    return manifest["hashes"]
+
+
+def invalidate_manifest(store) -> None:
+    """Deletes the manifest of a dataset, so that the next `sync_store` compares against the actual keys."""
+    try:
+        del store[manifest_key]
+    except KeyError:
+        pass
+
+
+def _upload_order(key):
+    name = key.rsplit("/", 1)[-1]
+    # The root zarr.json of a Zarr v3 dataset holds its consolidated metadata
+    if name == _consolidated_metadata_key or key == "zarr.json":
+        return 2
+    if name in _metadata_keys:
+        return 1
+    return 0
+
+
+def write_keys(staging_store, remote_store, keys, max_in_flight=16) -> None:
+    """Copies keys from `staging_store` to `remote_store`, with at most `max_in_flight` concurrent writes.
+
+    Returns once all the writes are confirmed. If a write fails, the writes in flight are completed and the error
+    is raised.
+    """
+    if max_in_flight <= 1:
+        for key in keys:
+            remote_store[key] = _to_bytes(staging_store[key])
+        return
+
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        in_flight = deque()
+        for key in keys:
+            if len(in_flight) >= max_in_flight:
+                in_flight.popleft().result()
+            in_flight.append(executor.submit(remote_store.__setitem__, key, _to_bytes(staging_store[key])))
+        while in_flight:
+            in_flight.popleft().result()
+
+
+def sync_store(staging_store, remote_store, verbose=False, max_in_flight=16) -> dict:
+    """Transmits to `remote_store` only the keys of `staging_store` whose content changed since the last sync.
+
+    Parameters
+    ----------
+    staging_store : MutableMapping
+        The complete dataset, encoded in memory.
+    remote_store : MutableMapping
+        The destination store, typically the `ObjectStore` of a backend (see `storage.py`). It must support
+        concurrent writes if `max_in_flight` is larger than 1.
+    verbose : bool, default: False
+        If True, print a summary of the transmitted and deleted keys.
+    max_in_flight : int, default: 16
+        The maximum number of keys transmitted concurrently. It is capped by the `max_concurrency` of the
+        destination store, if any, so that concurrent writes never wait for a connection of the backend's pool.
+
+    Returns
+    -------
+    summary : dict
+        The lists of "uploaded" and "deleted" keys and the number of "unchanged" keys.
+    """
+    max_concurrency = getattr(remote_store, "max_concurrency", None)
+    if max_concurrency is not None:
+        max_in_flight = min(max_in_flight, max_concurrency)
+
+    staging_hashes = compute_store_manifest(staging_store)
+    remote_hashes = load_manifest(remote_store)
+    has_manifest = remote_hashes is not None
+    if not has_manifest:
+        # Without a manifest nothing is known about the remote content: transmit everything and remove stale keys
+        remote_hashes = {}
+        stale_keys = [key for key in remote_store if key not in staging_hashes and key != manifest_key]
+    else:
+        stale_keys = [key for key in remote_hashes if key not in staging_hashes]
+
+    changed_keys = [key for key, digest in staging_hashes.items() if remote_hashes.get(key) != digest]
+    changed_keys = sorted(changed_keys, key=_upload_order)
+
+    # The old manifest is removed first, so that an interrupted sync is never mistaken for a complete one
+    if changed_keys or stale_keys:
+        invalidate_manifest(remote_store)
+    for order in range(3):
+        keys = [key for key in changed_keys if _upload_order(key) == order]
+        write_keys(staging_store, remote_store, keys, max_in_flight=max_in_flight)
+    for key in stale_keys:
+        try:
+            del remote_store[key]
+        except KeyError:
+            pass
+
+    if changed_keys or stale_keys or not has_manifest:
+        manifest = dict(version=manifest_version, hash="sha256", hashes=staging_hashes)
+        remote_store[manifest_key] = json.dumps(manifest, sort_keys=True).encode()
+
+    num_unchanged = len(staging_hashes) - len(changed_keys)
+    if verbose:
+        print(f"Uploaded {len(changed_keys)} keys, deleted {len(stale_keys)} keys, {num_unchanged} keys unchanged")
+
+    return dict(uploaded=changed_keys, deleted=stale_keys, unchanged=num_unchanged)
@@ -0,0 +1,182 @@
+"""
+Pipelined execution of multi-stage processing over many items (e.g. sessions in `upload_ibl_templates.py`).
+
+Each stage runs on its own pool of worker threads and stages are connected by bounded queues, so that different
+items are processed by different stages at the same time (e.g. the download of session k + 1 overlaps with the
+template computation of session k and with the upload of session k - 1). The bounded queues provide backpressure:
+a stage blocks when the next one falls behind, instead of accumulating items in memory or on disk.
+
+`DiskSpaceGate` adds disk-space-aware backpressure to stages that write local copies.
+"""
+
+import queue
+import shutil
+import threading
+import time
+from pathlib import Path
+
+_end_of_stream = object()
+
+
+class DiskSpaceGate:
+    """
+    Admits local copies only when there is room for them on disk.
+
+    A copy of `nbytes` is admitted when the disk keeps at least `min_free_bytes` free after all the admitted copies
+    are completely written, and (optionally) when the admitted copies do not exceed `max_cache_bytes` in total.
+    Callers `acquire` room before writing a copy, call `mark_written` once it is written and `release` once it is
+    deleted.
+
+    Parameters
+    ----------
+    folder : str or Path
+        The folder where local copies are written.
+    min_free_bytes : int, default: 0
+        The free space to preserve on the disk of `folder`.
+    max_cache_bytes : int, optional
+        The maximum total size of the admitted copies.
+    poll_interval : float, default: 5.0
+        How often (in seconds) free space is checked again while waiting, as it can also change externally.
+    """
+
+    def __init__(self, folder, min_free_bytes=0, max_cache_bytes=None, poll_interval=5.0):
+        self.folder = Path(folder)
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.min_free_bytes = min_free_bytes
+        self.max_cache_bytes = max_cache_bytes
+        self.poll_interval = poll_interval
+
+        self._condition = threading.Condition()
+        self._pending_bytes = 0
+        self._cached_bytes = 0
+        self._num_copies = 0
+
+    def _has_room(self, nbytes):
+        # Bytes of admitted copies that are not written yet are not reflected in the free space
+        free_bytes = shutil.disk_usage(self.folder).free - self._pending_bytes
+        if free_bytes - nbytes < self.min_free_bytes:
+            return False
+        if self.max_cache_bytes is not None and self._cached_bytes + nbytes > self.max_cache_bytes:
+            return False
+        return True
+
+    def acquire(self, nbytes):
+        """Blocks until a copy of `nbytes` can be admitted.
+
+        Raises
+        ------
+        OSError
+            If the copy does not fit even though no other copy is admitted.
+        """
+        with self._condition:
+            while not self._has_room(nbytes):
+                if self._num_copies == 0:
+                    raise OSError(f"Not enough disk space in {self.folder} for a local copy of {nbytes} bytes")
+                self._condition.wait(timeout=self.poll_interval)
+            self._pending_bytes += nbytes
+            self._cached_bytes += nbytes
+            self._num_copies += 1
+
+    def mark_written(self, nbytes):
+        """Signals that an admitted copy of `nbytes` is completely written (or was aborted)."""
+        with self._condition:
+            self._pending_bytes -= nbytes
+            self._condition.notify_all()
+
+    def release(self, nbytes):
+        """Signals that an admitted copy of `nbytes` was deleted."""
+        with self._condition:
+            self._cached_bytes -= nbytes
+            self._num_copies -= 1
+            self._condition.notify_all()
+
+
+def run_pipeline(items, stages, queue_size=1, verbose=False):
+    """Runs items through a sequence of stages, with the stages working concurrently on different items.
+
+    Parameters
+    ----------
+    items : iterable
+        The inputs of the first stage.
+    stages : list of dict
+        The stages, in order. Each stage is a dictionary with:
+
+        * "name": the stage name, used in messages
+        * "func": a function taking the output of the previous stage. If it returns None, the item is dropped.
+        * "num_workers" (optional, default 1): the number of items processed concurrently by the stage
+        * "expand" (optional, default False): if True, `func` returns a list of outputs, each of which is passed
+          on to the next stage separately
+    queue_size : int, default: 1
+        The maximum number of items waiting between two stages.
+    verbose : bool, default: False
+        If True, print the items that fail and the duration of each stage.
+
+    Returns
+    -------
+    results : list
+        The outputs of the last stage, in order of completion.
+    failures : list of dict
+        The items that raised an exception, with the "stage", the "item" and the "error". Failed items are
+        dropped and the other items continue through the pipeline.
+    """
+    queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+    num_workers = [stage.get("num_workers", 1) for stage in stages]
+    remaining_workers = list(num_workers)
+    results = []
+    failures = []
+    lock = threading.Lock()
+
+    def emit(stage_index, output):
+        if stage_index + 1 < len(stages):
+            queues[stage_index + 1].put(output)
+        else:
+            with lock:
+                results.append(output)
+
+    def work(stage_index):
+        stage = stages[stage_index]
+        while True:
+            item = queues[stage_index].get()
+            if item is _end_of_stream:
+                break
+            start_time = time.time()
+            try:
+                output = stage["func"](item)
+            except Exception as error:
+                with lock:
+                    failures.append(dict(stage=stage["name"], item=item, error=error))
+                if verbose:
+                    print(f"Stage {stage['name']} failed: {error!r}")
+                continue
+            if verbose:
+                print(f"Stage {stage['name']} done in {(time.time() - start_time) / 60.0: 2.2f} minutes")
+            outputs = output if stage.get("expand", False) else [output]
+            for stage_output in outputs:
+                if stage_output is not None:
+                    emit(stage_index, stage_output)
+
+        # The last worker of a stage to finish closes the input of the next stage
+        with lock:
+            remaining_workers[stage_index] -= 1
+            is_last_worker = remaining_workers[stage_index] == 0
+        if is_last_worker and stage_index + 1 < len(stages):
+            for _ in range(num_workers[stage_index + 1]):
+                queues[stage_index + 1].put(_end_of_stream)
+
+    threads = [
+        threading.Thread(target=work, args=(stage_index,), name=f"{stage['name']}-{worker_index}", daemon=True)
+        for stage_index, stage in enumerate(stages)
+        for worker_index in range(num_workers[stage_index])
+    ]
+    for thread in threads:
+        thread.start()
+
+    for item in items:
+        queues[0].put(item)
+    for _ in range(num_workers[0]):
+        queues[0].put(_end_of_stream)
+
+    for thread in threads:
+        thread.join()
+
+    return results, failures
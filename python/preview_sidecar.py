@@ -0,0 +1,234 @@
+"""
+Compact binary preview sidecars for the web viewer.
+
+`consolidate_datasets` writes one sidecar per probe model (`previews/<probe model>.htlp`), and one for the dataset
+shown by the web viewer (`previews/test_templates.htlp`), with everything the viewer needs to render a unit row: the
+channel locations and, for each unit, its labels (unit ID, best channel ID, brain area), number of spikes, amplitude,
+signal-to-noise ratio, and the indices and waveforms of its active channels. The unit of a row of `templates.csv` is
+the entry `preview_index` of the sidecar of its probe.
+
+The file is laid out for HTTP range requests (all values little-endian, all sections 4-byte aligned):
+
+* header (48 bytes): magic `b"HTLPREV\\0"`, uint32 version, uint32 num_units, uint32 num_layouts, uint32 reserved,
+  then uint64 offsets of the layout table, of the unit offset table and of the first unit record
+* layout table: for each channel layout, uint32 num_channels followed by num_channels (x, y) float32 pairs
+* unit offset table: for each unit, uint64 offset and uint32 length of its record, uint32 reserved (16 bytes)
+* unit records: uint32 layout_index, uint32 best_channel, uint32 num_samples, uint32 num_active_channels,
+  uint32 spikes_per_unit, float32 amplitude_uv, float32 signal_to_noise_ratio (NaN if unknown), uint32 nbefore,
+  float32 sampling_frequency, uint32 labels_length, then the labels (unit ID, best channel ID and brain area as
+  UTF-8, separated and padded to labels_length by NUL bytes), num_active_channels uint32 channel indices and
+  num_active_channels x num_samples float32 waveform samples (one waveform per active channel)
+
+A reader fetches the header, layout table and offset table once (they are contiguous at the start of the file), and
+then any unit with a single ranged GET of its record. `read_preview_header` and `read_preview_unit` are the
+reference reader, and `src/utils/PreviewUtils.js` is the viewer's reader.
+"""
+
+import re
+import struct
+
+import numpy as np
+
+preview_magic = b"HTLPREV\x00"
+preview_version = 2
+preview_extension = ".htlp"
+
+# Channels with a peak-to-peak of at least this fraction of the best channel's are plotted by the viewer
+preview_active_channel_threshold = 0.1
+
+_header_struct = struct.Struct("<8sIIIIQQQ")
+_offset_struct = struct.Struct("<QII")
+_record_header_struct = struct.Struct("<IIIIIffIfI")
+
+
+def get_preview_file_name(probe: str) -> str:
+    """Returns the sidecar file name of a probe model (e.g. "Neuropixels 1.0" -> "Neuropixels_1.0.htlp")."""
+    return re.sub(r"[^A-Za-z0-9._-]+", "_", probe) + preview_extension
+
+
+def get_preview_active_channels(peak_to_peak, best_channel: int) -> np.ndarray:
+    """Returns the indices of the channels plotted by the viewer for a unit.
+
+    Parameters
+    ----------
+    peak_to_peak : np.ndarray
+        The peak-to-peak value of the unit on each channel.
+    best_channel : int
+        The index of the best channel of the unit.
+
+    Returns
+    -------
+    active_channels : np.ndarray
+        The sorted indices of the channels with a peak-to-peak of at least `preview_active_channel_threshold` times
+        the one of the best channel (which is always included).
+    """
+    peak_to_peak = np.asarray(peak_to_peak)
+    active_mask = peak_to_peak >= preview_active_channel_threshold * peak_to_peak[best_channel]
+    active_mask[best_channel] = True
+    return np.flatnonzero(active_mask)
+
+
+def encode_preview_sidecar(channel_layouts, units) -> bytes:
+    """Encodes a preview sidecar.
+
+    Parameters
+    ----------
+    channel_layouts : list of np.ndarray
+        The distinct channel locations of the probe model, with shape (num_channels, 2).
+    units : list of dict
+        One entry per unit with the "layout_index" (in `channel_layouts`), "best_channel", "unit_id",
+        "best_channel_id", "brain_area", "spikes_per_unit", "amplitude_uv", "signal_to_noise_ratio", "nbefore",
+        "sampling_frequency", "active_channels" (see `get_preview_active_channels`) and "waveforms" (the template on
+        the active channels, with shape (num_active_channels, num_samples)).
+
+    Returns
+    -------
+    sidecar : bytes
+        The encoded sidecar.
+    """
+    layout_table = bytearray()
+    for channel_locations in channel_layouts:
+        channel_locations = np.asarray(channel_locations, dtype="<f4")[:, :2]
+        layout_table += struct.pack("<I", len(channel_locations))
+        layout_table += np.ascontiguousarray(channel_locations).tobytes()
+
+    records = []
+    for unit in units:
+        labels = "\0".join(str(unit[key]) for key in ("unit_id", "best_channel_id", "brain_area")).encode("utf-8")
+        labels += b"\0" * (4 - len(labels) % 4)
+        active_channels = np.asarray(unit["active_channels"], dtype="<u4")
+        waveforms = np.asarray(unit["waveforms"], dtype="<f4").reshape(len(active_channels), -1)
+        record_header = _record_header_struct.pack(
+            int(unit["layout_index"]),
+            int(unit["best_channel"]),
+            waveforms.shape[1],
+            len(active_channels),
+            int(unit["spikes_per_unit"]),
+            float(unit["amplitude_uv"]),
+            float(unit["signal_to_noise_ratio"]),
+            int(unit["nbefore"]),
+            float(unit["sampling_frequency"]),
+            len(labels),
+        )
+        records.append(record_header + labels + active_channels.tobytes() + waveforms.tobytes())
+
+    layouts_offset = _header_struct.size
+    offset_table_offset = layouts_offset + len(layout_table)
+    records_offset = offset_table_offset + _offset_struct.size * len(units)
+
+    offset_table = bytearray()
+    record_offset = records_offset
+    for record in records:
+        offset_table += _offset_struct.pack(record_offset, len(record), 0)
+        record_offset += len(record)
+
+    header = _header_struct.pack(
+        preview_magic,
+        preview_version,
+        len(units),
+        len(channel_layouts),
+        0,
+        layouts_offset,
+        offset_table_offset,
+        records_offset,
+    )
+    return b"".join([header, layout_table, offset_table] + records)
+
+
+def read_preview_header(file) -> dict:
+    """Reads the header, the channel layouts and the unit offset table of a preview sidecar.
+
+    Parameters
+    ----------
+    file : file-like
+        The sidecar, opened in binary mode (e.g. with `open(path, "rb")` or `fsspec.open(url, "rb")`).
+
+    Returns
+    -------
+    header : dict
+        The "version", "num_units", "channel_layouts" (list of arrays with shape (num_channels, 2)), and the
+        "record_offsets" and "record_lengths" of the units.
+
+    Raises
+    ------
+    ValueError
+        If the file is not a preview sidecar or has an unsupported version.
+    """
+    file.seek(0)
+    magic, version, num_units, num_layouts, _, layouts_offset, offset_table_offset, records_offset = _header_struct.unpack(
+        file.read(_header_struct.size)
+    )
+    if magic != preview_magic:
+        raise ValueError("Not a template preview sidecar")
+    if version != preview_version:
+        raise ValueError(f"Unsupported preview sidecar version {version} (expected {preview_version})")
+
+    file.seek(layouts_offset)
+    prefix = file.read(records_offset - layouts_offset)
+    channel_layouts = []
+    position = 0
+    for _ in range(num_layouts):
+        (num_channels,) = struct.unpack_from("<I", prefix, position)
+        position += 4
+        channel_locations = np.frombuffer(prefix, dtype="<f4", count=2 * num_channels, offset=position)
+        channel_layouts.append(channel_locations.reshape(num_channels, 2))
+        position += 8 * num_channels
+
+    offset_table = np.frombuffer(
+        prefix,
+        dtype=np.dtype([("offset", "<u8"), ("length", "<u4"), ("reserved", "<u4")]),
+        count=num_units,
+        offset=offset_table_offset - layouts_offset,
+    )
+    return dict(
+        version=version,
+        num_units=num_units,
+        channel_layouts=channel_layouts,
+        record_offsets=offset_table["offset"],
+        record_lengths=offset_table["length"],
+    )
+
+
+def read_preview_unit(file, header: dict, unit_index: int) -> dict:
+    """Reads the record of one unit of a preview sidecar (a single ranged read).
+
+    Parameters
+    ----------
+    file : file-like
+        The sidecar, opened in binary mode.
+    header : dict
+        The header of the sidecar (see `read_preview_header`).
+    unit_index : int
+        The index of the unit (the "preview_index" column of `templates.csv`).
+
+    Returns
+    -------
+    unit : dict
+        The fields of the unit record (see `encode_preview_sidecar`).
+    """
+    file.seek(int(header["record_offsets"][unit_index]))
+    record = file.read(int(header["record_lengths"][unit_index]))
+    fields = _record_header_struct.unpack_from(record)
+    layout_index, best_channel, num_samples, num_active_channels, spikes_per_unit = fields[:5]
+    amplitude_uv, snr, nbefore, sampling_frequency, labels_length = fields[5:]
+
+    position = _record_header_struct.size
+    unit_id, best_channel_id, brain_area = record[position : position + labels_length].decode("utf-8").split("\0")[:3]
+    position += labels_length
+    active_channels = np.frombuffer(record, dtype="<u4", count=num_active_channels, offset=position)
+    position += 4 * num_active_channels
+    waveforms = np.frombuffer(record, dtype="<f4", count=num_active_channels * num_samples, offset=position)
+    return dict(
+        layout_index=layout_index,
+        best_channel=best_channel,
+        unit_id=unit_id,
+        best_channel_id=best_channel_id,
+        brain_area=brain_area,
+        spikes_per_unit=spikes_per_unit,
+        amplitude_uv=amplitude_uv,
+        signal_to_noise_ratio=snr,
+        nbefore=nbefore,
+        sampling_frequency=sampling_frequency,
+        active_channels=active_channels,
+        waveforms=waveforms.reshape(num_active_channels, num_samples),
+    )
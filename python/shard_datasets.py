@@ -0,0 +1,230 @@
+"""
+This script migrates template datasets in the "spikeinterface-template-database" bucket to a sharded Zarr layout.
+New datasets can also be written directly in the sharded layout by the upload scripts (`sharded=True`, see
+`encode_sharded_staging_store`).
+
+Datasets written with the default Zarr v2 chunking end up as many small S3 objects, so listing, reading and
+deleting a dataset costs one request per object. In the sharded layout (Zarr v3 sharding codec) each unit is
+stored in its own chunk, and many unit chunks are packed into a few large shard objects which readers access
+with byte-range requests.
+
+The migration works dataset by dataset:
+
+1. the original dataset is read and re-encoded in the sharded layout in memory, and the copy is verified;
+2. the sharded copy is written over the original dataset with `incremental_upload.sync_store`, and verified.
+
+The Zarr v3 keys of the sharded layout do not collide with the Zarr v2 keys of the original, and `sync_store` writes
+the shards first (concurrently, with multipart uploads for large shards), then the array metadata, then the root
+`zarr.json` (which switches readers to the sharded layout), and only then deletes the Zarr v2 keys. The original
+dataset therefore stays complete and readable until the sharded copy is.
+
+Migrated datasets can only be read by Zarr v3 readers (e.g. zarr-python >= 3 or zarrita), not by Zarr v2 readers such
+as zarr-python 2 or the zarr.js of web viewer builds older than the preview sidecars. The dataset shown by the web
+viewer (`test_templates.zarr`) is therefore only migrated when it is given explicitly.
+"""
+
+from argparse import ArgumentParser
+
+import numpy as np
+import zarr
+
+from consolidate_datasets import open_template_dataset
+from incremental_upload import invalidate_manifest, sync_store
+from storage import get_backend
+from zarr_utils import read_array
+
+parser = ArgumentParser(description="Migrate datasets from spikeinterface template database to a sharded Zarr layout")
+
+parser.add_argument(
+    "datasets", nargs="*", help="Datasets to migrate (default: all datasets in the bucket except test_templates.zarr)"
+)
+parser.add_argument("--units-per-shard", type=int, default=64, help="Number of unit chunks stored in each shard")
+parser.add_argument("--dry-run", action="store_true", help="Dry run (only re-encode and verify in memory)")
+parser.add_argument("--verbose", action="store_true", help="Print additional information during processing")
+
+# Shown by the web viewer, whose older builds read it with zarr.js (Zarr v2 only): only migrated when given explicitly
+datasets_to_avoid = ["test_templates.zarr"]
+
+
+def write_sharded_dataset(source_group, store, units_per_shard: int = 64, storage_options: dict | None = None):
+    """Writes a copy of a template dataset using the sharded (Zarr v3) layout.
+
+    Arrays indexed by unit along their first axis with two or more dimensions (e.g. `templates_array` and
+    `peak_to_peak`) are stored with one chunk per unit and `units_per_shard` chunks per shard. All other arrays
+    are small and are stored as a single chunk.
+
+    Parameters
+    ----------
+    source_group : zarr.Group
+        The template dataset to copy. Can be in the default or in the sharded layout.
+    store : str or zarr.abc.store.Store
+        Destination of the sharded copy (e.g. "s3://bucket/dataset.zarr" or a `zarr.storage.MemoryStore`).
+        Existing content at the destination is overwritten.
+    units_per_shard : int, default: 64
+        The number of unit chunks stored in each shard.
+    storage_options : dict, optional
+        Options passed to fsspec when `store` is a URL.
+
+    Returns
+    -------
+    sharded_group : zarr.Group
+        The sharded copy, with consolidated metadata.
+    """
+    num_units = source_group["unit_ids"].shape[0]
+    sharded_group = zarr.open_group(store=store, mode="w", zarr_format=3, storage_options=storage_options)
+    sharded_group.attrs.update(source_group.attrs.asdict())
+
+    for path, node in sorted(source_group.members(max_depth=None)):
+        if isinstance(node, zarr.Group):
+            sharded_group.create_group(path, attributes=node.attrs.asdict())
+            continue
+
+        data = read_array(node)
+        dtype = str if data.dtype.kind == "U" else data.dtype
+        if data.ndim >= 2 and data.shape[0] == num_units:
+            chunks = (1,) + data.shape[1:]
+            shards = (min(units_per_shard, num_units),) + data.shape[1:]
+        else:
+            chunks = tuple(max(n, 1) for n in data.shape)
+            shards = None
+        array = sharded_group.create_array(
+            path,
+            shape=data.shape,
+            dtype=dtype,
+            chunks=chunks,
+            shards=shards,
+            attributes=node.attrs.asdict(),
+        )
+        array[...] = data
+
+    zarr.consolidate_metadata(sharded_group.store)
+    return zarr.open_consolidated(sharded_group.store, zarr_format=3)
+
+
+def encode_sharded_staging_store(staging_store: dict, units_per_shard: int = 64) -> dict:
+    """Re-encodes a dataset staged in memory in the default layout (see `zarr_utils.create_staging_group`) in the
+    sharded layout, so that upload scripts can write new datasets directly in the sharded layout.
+
+    Parameters
+    ----------
+    staging_store : dict
+        The in-memory store of the dataset, with consolidated metadata.
+    units_per_shard : int, default: 64
+        The number of unit chunks stored in each shard.
+
+    Returns
+    -------
+    sharded_store : dict
+        The in-memory store of the verified sharded copy, to upload with `incremental_upload.sync_store`.
+    """
+    source_group = zarr.open_consolidated(zarr.storage.MemoryStore(staging_store), mode="r")
+    sharded_store = {}
+    sharded_group = write_sharded_dataset(
+        source_group, zarr.storage.MemoryStore(sharded_store), units_per_shard=units_per_shard
+    )
+    verify_sharded_dataset(source_group, sharded_group)
+    return sharded_store
+
+
+def verify_sharded_dataset(source_group, sharded_group) -> None:
+    """Checks that a sharded copy holds the same arrays and attributes as its source dataset.
+
+    Raises
+    ------
+    ValueError
+        If any array or attribute of the source is missing from or differs in the sharded copy.
+    """
+    mismatches = []
+    if source_group.attrs.asdict() != sharded_group.attrs.asdict():
+        mismatches.append("root attributes")
+
+    sharded_members = dict(sharded_group.members(max_depth=None))
+    for path, node in source_group.members(max_depth=None):
+        if path not in sharded_members:
+            mismatches.append(f"{path} (missing)")
+            continue
+        sharded_node = sharded_members[path]
+        if node.attrs.asdict() != sharded_node.attrs.asdict():
+            mismatches.append(f"{path} (attributes)")
+        if isinstance(node, zarr.Array) and not np.array_equal(read_array(node), read_array(sharded_node)):
+            mismatches.append(f"{path} (data)")
+
+    if mismatches:
+        raise ValueError(f"Sharded copy differs from source: {', '.join(mismatches)}")
+
+
+def migrate_datasets_to_sharded_layout(
+    datasets: list[str] | None = None,
+    units_per_shard: int = 64,
+    dry_run: bool = False,
+    verbose: bool = False,
+) -> list[str]:
+    """Migrates template datasets in the template database to the sharded layout, one dataset at a time.
+
+    Parameters
+    ----------
+    datasets : list of str, optional
+        The dataset keys to migrate. If None, all datasets in the bucket are migrated, except the ones in
+        `datasets_to_avoid` (e.g. the dataset shown by the web viewer).
+    units_per_shard : int, default: 64
+        The number of unit chunks stored in each shard.
+    dry_run : bool, default: False
+        If True, datasets are only re-encoded and verified in memory, and nothing is written to the template database.
+    verbose : bool, default: False
+        If True, print additional information during processing.
+
+    Returns
+    -------
+    migrated_datasets : list of str
+        The datasets that were migrated (or would be migrated, in a dry run).
+    """
+    backend = get_backend()
+    existing_datasets = backend.list_datasets()
+    if datasets is None:
+        datasets = sorted(d for d in existing_datasets if d not in datasets_to_avoid)
+
+    migrated_datasets = []
+    for dataset in datasets:
+        if dataset not in existing_datasets:
+            raise FileNotFoundError(f"Dataset {dataset} not found in bucket: {backend.bucket_name}")
+
+        dataset_path = backend.get_url(dataset)
+        source_group = open_template_dataset(dataset_path, storage_options=backend.storage_options)
+        if source_group.metadata.zarr_format == 3:
+            if verbose:
+                print(f"Dataset {dataset} already in sharded layout, skipping")
+            continue
+
+        if verbose:
+            print(f"Processing dataset: {dataset}")
+        local_store = {}
+        local_group = write_sharded_dataset(
+            source_group, zarr.storage.MemoryStore(local_store), units_per_shard=units_per_shard
+        )
+        verify_sharded_dataset(source_group, local_group)
+        migrated_datasets.append(dataset)
+        if dry_run:
+            if verbose:
+                print(f"\tDry run: {dataset} verified in memory")
+            continue
+
+        if verbose:
+            print(f"\tWriting sharded copy over the original dataset")
+        dataset_store = backend.get_object_store(dataset)
+        # Without a manifest, sync_store lists the actual keys of the dataset and deletes all the Zarr v2 keys
+        invalidate_manifest(dataset_store)
+        sync_store(local_store, dataset_store, verbose=verbose)
+        sharded_group = open_template_dataset(dataset_path, storage_options=backend.storage_options)
+        verify_sharded_dataset(local_group, sharded_group)
+
+    return migrated_datasets
+
+
+if __name__ == "__main__":
+    params = parser.parse_args()
+    migrate_datasets_to_sharded_layout(
+        datasets=params.datasets or None,
+        units_per_shard=params.units_per_shard,
+        dry_run=params.dry_run,
+        verbose=params.verbose,
+    )
@@ -0,0 +1,397 @@
+"""
+Storage backends for the template database.
+
+All the tools in this folder access the template database through a backend, which holds the bucket
+configuration and pooled, reused clients:
+
+* `S3Backend`: the "spikeinterface-template-database" bucket on AWS S3 (default). A single boto3 client and a
+  single s3fs file system are shared by all the tools of a process, with connection pools sized for
+  `max_concurrency` concurrent requests and adaptive retries with exponential backoff.
+* `LocalBackend`: a local directory with the same layout as the bucket (one folder per dataset and the
+  `templates.csv` index), used to run and benchmark the tools offline against a local mirror (see
+  `mirror_datasets`).
+
+The backend of a process is returned by `get_backend` and is configured with environment variables:
+
+* `HTL_STORAGE`: "s3" (default) or "local"
+* `HTL_BUCKET` and `HTL_REGION`: the S3 bucket and its region
+* `HTL_LOCAL_ROOT`: the root directory of the local backend
+* `HTL_MAX_CONCURRENCY`: the maximum number of concurrent requests (default 32)
+* `HTL_MAX_RETRIES`: the maximum number of attempts per S3 request (default 10)
+"""
+
+import io
+import os
+import shutil
+from collections.abc import MutableMapping
+from functools import cached_property
+from pathlib import Path
+
+default_bucket_name = "spikeinterface-template-database"
+default_region_name = "us-east-2"
+default_max_concurrency = 32
+default_max_retries = 10
+default_multipart_threshold = 16 * 1024**2
+
+_backend = None
+
+
+class S3Backend:
+    """
+    Template database stored in an S3 bucket.
+
+    Parameters
+    ----------
+    bucket_name : str, default: "spikeinterface-template-database"
+        The bucket name.
+    region_name : str, default: "us-east-2"
+        The bucket region.
+    max_concurrency : int, default: 32
+        The maximum number of concurrent requests, e.g. of object writes in flight with `incremental_upload.sync_store`.
+        As each write can be a multipart upload with `multipart_max_concurrency` parts in flight, the connection pools
+        of the shared clients hold `max_concurrency * multipart_max_concurrency` connections.
+    max_retries : int, default: 10
+        The maximum number of attempts per request. Failed requests are retried with exponential backoff
+        (botocore "adaptive" retry mode, which also rate-limits the client when S3 throttles requests).
+    anonymous_reads : bool, default: True
+        If True, datasets are read without credentials (the bucket is public). Writes always use the
+        credentials of the environment.
+    multipart_threshold : int, default: 16 MiB
+        Objects of at least this size (e.g. large shards) are written with multipart uploads of parts of this size.
+    multipart_max_concurrency : int, default: 4
+        The number of parts of a multipart upload transmitted concurrently.
+    """
+
+    def __init__(
+        self,
+        bucket_name=default_bucket_name,
+        region_name=default_region_name,
+        max_concurrency=default_max_concurrency,
+        max_retries=default_max_retries,
+        anonymous_reads=True,
+        multipart_threshold=default_multipart_threshold,
+        multipart_max_concurrency=4,
+    ):
+        self.bucket_name = bucket_name
+        self.region_name = region_name
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.anonymous_reads = anonymous_reads
+        self.multipart_threshold = multipart_threshold
+        self.multipart_max_concurrency = multipart_max_concurrency
+
+    def __repr__(self):
+        return f"S3Backend(bucket_name={self.bucket_name!r}, region_name={self.region_name!r})"
+
+    @property
+    def _config_kwargs(self):
+        return dict(
+            # Every concurrent request can be a multipart upload transmitting several parts at once
+            max_pool_connections=self.max_concurrency * self.multipart_max_concurrency,
+            retries=dict(max_attempts=self.max_retries, mode="adaptive"),
+        )
+
+    @cached_property
+    def client(self):
+        """The shared boto3 S3 client."""
+        import boto3
+        from botocore.config import Config
+
+        return boto3.client("s3", region_name=self.region_name, config=Config(**self._config_kwargs))
+
+    @cached_property
+    def transfer_config(self):
+        """The boto3 transfer configuration used for multipart uploads."""
+        from boto3.s3.transfer import TransferConfig
+
+        return TransferConfig(
+            multipart_threshold=self.multipart_threshold,
+            multipart_chunksize=self.multipart_threshold,
+            max_concurrency=self.multipart_max_concurrency,
+        )
+
+    @cached_property
+    def filesystem(self):
+        """The shared s3fs file system, used for the Zarr stores written by the tools."""
+        import s3fs
+
+        return s3fs.S3FileSystem(**self.write_storage_options)
+
+    @property
+    def storage_options(self):
+        """The fsspec options to read datasets from their URL (see `get_url`)."""
+        if self.anonymous_reads:
+            return dict(anon=True)
+        return self.write_storage_options
+
+    @property
+    def write_storage_options(self):
+        """The fsspec options to write datasets to their URL (see `get_url`)."""
+        return dict(
+            anon=False,
+            client_kwargs=dict(region_name=self.region_name),
+            config_kwargs=self._config_kwargs,
+        )
+
+    def get_url(self, key):
+        """Returns the URL of a key, e.g. to open a dataset with `zarr` or to read `templates.csv` with pandas."""
+        return f"s3://{self.bucket_name}/{key}"
+
+    def get_mapper(self, key):
+        """Returns a read-write Zarr store (MutableMapping) for the dataset at `key`."""
+        import s3fs
+
+        return s3fs.S3Map(root=f"{self.bucket_name}/{key}", s3=self.filesystem)
+
+    def get_object_store(self, key):
+        """Returns a store (MutableMapping) for the dataset at `key` that writes through the shared boto3 client."""
+        return ObjectStore(self, key)
+
+    def list_datasets(self):
+        """Lists the keys of the top-level Zarr datasets."""
+        zarr_directories = set()
+
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket_name, Delimiter="/"):
+            for prefix in page.get("CommonPrefixes", []):
+                key = prefix["Prefix"]
+                if key.endswith(".zarr/"):
+                    zarr_directories.add(key.rstrip("/"))
+
+        return list(zarr_directories)
+
+    def list_objects(self, prefix):
+        """Yields the (key, size in bytes) of all objects whose key starts with `prefix`."""
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=prefix):
+            for obj in page.get("Contents", []):
+                yield obj["Key"], obj["Size"]
+
+    def exists(self, key):
+        from botocore.exceptions import ClientError
+
+        try:
+            self.client.head_object(Bucket=self.bucket_name, Key=key)
+        except ClientError:
+            return False
+        return True
+
+    def get_object(self, key):
+        try:
+            response = self.client.get_object(Bucket=self.bucket_name, Key=key)
+        except self.client.exceptions.NoSuchKey:
+            raise KeyError(key)
+        return response["Body"].read()
+
+    def put_object(self, key, data):
+        """Writes an object, with a multipart upload if it is larger than `multipart_threshold`."""
+        if len(data) < self.multipart_threshold:
+            self.client.put_object(Bucket=self.bucket_name, Key=key, Body=data)
+        else:
+            self.client.upload_fileobj(io.BytesIO(data), self.bucket_name, key, Config=self.transfer_config)
+
+    def delete_object(self, key):
+        self.client.delete_object(Bucket=self.bucket_name, Key=key)
+
+    def upload_file(self, file_path, key):
+        self.client.upload_file(Filename=str(file_path), Bucket=self.bucket_name, Key=key)
+
+    def delete_prefix(self, prefix):
+        """Deletes all objects whose key starts with `prefix`."""
+        # Each page holds at most 1000 keys, which is also the limit of a single delete request
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=prefix):
+            objects = [{"Key": obj["Key"]} for obj in page.get("Contents", [])]
+            if objects:
+                self.client.delete_objects(Bucket=self.bucket_name, Delete={"Objects": objects})
+
+
+class LocalBackend:
+    """
+    Template database stored in a local directory, with the same layout and interface as `S3Backend`.
+
+    Parameters
+    ----------
+    root : str or Path
+        The directory that stands in for the bucket.
+    """
+
+    storage_options = None
+    write_storage_options = None
+
+    def __init__(self, root):
+        self.root = Path(root).absolute()
+        self.bucket_name = str(self.root)
+
+    def __repr__(self):
+        return f"LocalBackend(root={str(self.root)!r})"
+
+    def _path(self, key):
+        return self.root / key
+
+    def get_url(self, key):
+        return str(self._path(key))
+
+    def get_mapper(self, key):
+        import fsspec
+
+        return fsspec.get_mapper(self.get_url(key), auto_mkdir=True)
+
+    def get_object_store(self, key):
+        return ObjectStore(self, key)
+
+    def list_datasets(self):
+        if not self.root.is_dir():
+            return []
+        return [path.name for path in self.root.iterdir() if path.is_dir() and path.name.endswith(".zarr")]
+
+    def list_objects(self, prefix):
+        # Keys use "/" as separator, as on S3
+        parent = self._path(prefix.rsplit("/", 1)[0]) if "/" in prefix else self.root
+        if not parent.is_dir():
+            return
+        for path in sorted(parent.rglob("*")):
+            key = path.relative_to(self.root).as_posix()
+            if path.is_file() and key.startswith(prefix):
+                yield key, path.stat().st_size
+
+    def exists(self, key):
+        return self._path(key).is_file()
+
+    def get_object(self, key):
+        try:
+            return self._path(key).read_bytes()
+        except FileNotFoundError:
+            raise KeyError(key)
+
+    def put_object(self, key, data):
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
+
+    def delete_object(self, key):
+        try:
+            self._path(key).unlink()
+        except FileNotFoundError:
+            raise KeyError(key)
+
+    def upload_file(self, file_path, key):
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        shutil.copyfile(file_path, path)
+
+    def delete_prefix(self, prefix):
+        for key, _ in list(self.list_objects(prefix)):
+            self._path(key).unlink()
+        # Remove the folders left empty
+        folder = self._path(prefix.rstrip("/"))
+        if prefix.endswith("/") and folder.is_dir():
+            shutil.rmtree(folder)
+
+
+class ObjectStore(MutableMapping):
+    """
+    Store of the keys of a dataset, with one object per key, backed by the `get_object`, `put_object`,
+    `delete_object` and `list_objects` methods of a backend.
+
+    Unlike the fsspec mappers returned by `get_mapper`, writes go through the shared boto3 client of the backend, so
+    they can be issued concurrently from many threads and large objects are written with multipart uploads. Used
+    as the destination of `incremental_upload.sync_store`.
+
+    Parameters
+    ----------
+    backend : S3Backend or LocalBackend
+        The backend holding the dataset.
+    prefix : str
+        The key of the dataset in the backend.
+    """
+
+    def __init__(self, backend, prefix):
+        self.backend = backend
+        self.prefix = prefix.rstrip("/")
+
+    def __repr__(self):
+        return f"ObjectStore({self.backend!r}, {self.prefix!r})"
+
+    @property
+    def max_concurrency(self):
+        """The maximum number of concurrent writes supported by the backend, or None if there is no limit."""
+        return getattr(self.backend, "max_concurrency", None)
+
+    def __getitem__(self, key):
+        return self.backend.get_object(f"{self.prefix}/{key}")
+
+    def __setitem__(self, key, value):
+        self.backend.put_object(f"{self.prefix}/{key}", bytes(value))
+
+    def __delitem__(self, key):
+        self.backend.delete_object(f"{self.prefix}/{key}")
+
+    def __iter__(self):
+        for key, _ in self.backend.list_objects(f"{self.prefix}/"):
+            yield key[len(self.prefix) + 1 :]
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+def get_backend():
+    """Returns the storage backend of the process, creating it from the environment variables on first use."""
+    global _backend
+    if _backend is None:
+        storage = os.environ.get("HTL_STORAGE", "s3")
+        if storage == "local":
+            if "HTL_LOCAL_ROOT" not in os.environ:
+                raise ValueError("HTL_LOCAL_ROOT must be set when HTL_STORAGE is 'local'")
+            _backend = LocalBackend(os.environ["HTL_LOCAL_ROOT"])
+        elif storage == "s3":
+            _backend = S3Backend(
+                bucket_name=os.environ.get("HTL_BUCKET", default_bucket_name),
+                region_name=os.environ.get("HTL_REGION", default_region_name),
+                max_concurrency=int(os.environ.get("HTL_MAX_CONCURRENCY", default_max_concurrency)),
+                max_retries=int(os.environ.get("HTL_MAX_RETRIES", default_max_retries)),
+            )
+        else:
+            raise ValueError(f"HTL_STORAGE must be 's3' or 'local', not {storage!r}")
+    return _backend
+
+
+def set_backend(backend):
+    """Sets the storage backend used by all the tools of the process."""
+    global _backend
+    _backend = backend
+
+
+def mirror_datasets(source, destination, datasets=None, include_index=True, verbose=False):
+    """Copies datasets (and the templates.csv index) from one backend to another, e.g. from S3 to a local mirror.
+
+    Parameters
+    ----------
+    source, destination : S3Backend or LocalBackend
+        The backends to copy from and to.
+    datasets : list of str, optional
+        The datasets to copy. If None, all the datasets of `source` are copied.
+    include_index : bool, default: True
+        If True, the templates.csv index is also copied (if it exists).
+    verbose : bool, default: False
+        If True, print additional information during processing.
+
+    Returns
+    -------
+    num_bytes : int
+        The number of bytes copied.
+    """
+    datasets = sorted(source.list_datasets()) if datasets is None else datasets
+    keys = [(key, size) for dataset in datasets for key, size in source.list_objects(f"{dataset}/")]
+    if include_index and source.exists("templates.csv"):
+        keys.append(("templates.csv", None))
+
+    num_bytes = 0
+    for key, _ in keys:
+        data = source.get_object(key)
+        destination.put_object(key, data)
+        num_bytes += len(data)
+    if verbose:
+        print(f"Copied {len(datasets)} datasets ({len(keys)} objects, {num_bytes / 1024**2:.1f} MB) to {destination}")
+
+    return num_bytes
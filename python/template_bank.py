@@ -0,0 +1,190 @@
+"""
+Cache of sub-sample-shifted template banks for hybrid injection.
+
+Realistic injections place spikes at fractional sample times. Instead of shifting a template by FFT for every
+spike, the bank precomputes `num_shifts` shifted versions of each selected template, with shifts of
+k / num_shifts samples (k = 0, ..., num_shifts - 1), using one batched FFT over units. Shifted version k of a
+template has its peak at `nbefore + k / num_shifts` samples. Templates are zero-padded before the FFT, so that the
+end of a template does not wrap around into its first samples.
+
+Banks are saved as `.npy` files (with a `.json` metadata sidecar) in a cache folder, keyed by the selected
+datasets, template indices and number of shifts, and by a fingerprint of the content of the datasets (tools such as
+`delete_templates` change the unit of a template index in place). They are loaded memory-mapped so that all the
+injection workers of a machine share one copy through the page cache.
+"""
+
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+
+from incremental_upload import manifest_key
+
+template_bank_version = 2
+
+# Keys that change whenever the units of a dataset change: the consolidated metadata (Zarr v2 or v3) and the manifest
+_fingerprint_keys = (".zmetadata", "zarr.json", manifest_key)
+
+
+def compute_shifted_templates(templates_array, num_shifts, units_per_batch=64, out=None):
+    """Computes sub-sample-shifted versions of templates with a batched FFT along the time axis.
+
+    Parameters
+    ----------
+    templates_array : np.ndarray
+        The templates, with shape (num_units, num_samples, num_channels).
+    num_shifts : int
+        The number of shifts per template. Shift k delays the template by k / num_shifts samples.
+    units_per_batch : int, default: 64
+        The number of templates transformed at once, which bounds memory usage.
+    out : np.ndarray, optional
+        An array of shape (num_units, num_shifts, num_samples, num_channels) to write into
+        (e.g. a memory-mapped `.npy` file).
+
+    Returns
+    -------
+    shifted_templates : np.ndarray
+        The shifted templates (float32), with shape (num_units, num_shifts, num_samples, num_channels).
+    """
+    num_units, num_samples, num_channels = templates_array.shape
+    if out is None:
+        out = np.zeros((num_units, num_shifts, num_samples, num_channels), dtype="float32")
+
+    # The FFT shift is circular: zero-pad so that the end of a template does not wrap around into its start
+    num_fft_samples = 2 * num_samples
+
+    # Phase ramps exp(-2j * pi * f * shift) with shape (num_shifts, num_frequencies, 1)
+    frequencies = np.fft.rfftfreq(num_fft_samples)
+    shifts = np.arange(num_shifts) / num_shifts
+    phase_ramps = np.exp(-2j * np.pi * shifts[:, None] * frequencies[None, :])[:, :, None]
+
+    for start in range(0, num_units, units_per_batch):
+        batch = np.asarray(templates_array[start : start + units_per_batch], dtype="float32")
+        spectra = np.fft.rfft(batch, n=num_fft_samples, axis=1)
+        shifted = np.fft.irfft(spectra[:, None, :, :] * phase_ramps[None], n=num_fft_samples, axis=2)
+        out[start : start + len(batch)] = shifted[:, :, :num_samples]
+
+    return out
+
+
+def get_dataset_fingerprint(dataset_path):
+    """Returns a hash of the consolidated metadata and of the upload manifest of a dataset.
+
+    The fingerprint changes whenever units are added to or removed from the dataset (which changes the array
+    shapes in the consolidated metadata) and whenever the dataset is uploaded again with different content.
+    """
+    import fsspec
+
+    dataset_path = str(dataset_path)
+    storage_options = dict(anon=True) if dataset_path.startswith("s3://") else {}
+    filesystem, root = fsspec.core.url_to_fs(dataset_path, **storage_options)
+    digest = hashlib.sha256()
+    for key in _fingerprint_keys:
+        try:
+            content = filesystem.cat_file(f"{root.rstrip('/')}/{key}")
+        except FileNotFoundError:
+            content = b""
+        digest.update(key.encode() + hashlib.sha256(content).digest())
+    return digest.hexdigest()
+
+
+def get_template_bank_key(dataset_paths, template_indices, num_shifts, dataset_fingerprints):
+    """Returns the cache key of the bank of a template selection.
+
+    `dataset_fingerprints` maps each dataset path to its fingerprint (see `get_dataset_fingerprint`).
+    """
+    selection = dict(
+        version=template_bank_version,
+        dataset_paths=[str(path) for path in dataset_paths],
+        template_indices=[int(index) for index in template_indices],
+        num_shifts=int(num_shifts),
+        dataset_fingerprints={str(path): dataset_fingerprints[path] for path in dict.fromkeys(dataset_paths)},
+    )
+    return hashlib.sha256(json.dumps(selection).encode()).hexdigest()[:32]
+
+
+def get_template_bank(templates_info, num_shifts, cache_folder=None, units_per_batch=64, verbose=False):
+    """Returns the memory-mapped bank of shifted templates of a selection, computing and caching it if needed.
+
+    Parameters
+    ----------
+    templates_info : pandas.DataFrame
+        Rows of the templates index selecting the templates (see `hybrid_injection.load_templates_from_index`).
+    num_shifts : int
+        The number of sub-sample shifts per template.
+    cache_folder : str or Path, optional
+        The folder where banks are cached. Defaults to "./build/template_banks".
+    units_per_batch : int, default: 64
+        The number of templates transformed at once.
+    verbose : bool, default: False
+        If True, print additional information during processing.
+
+    Returns
+    -------
+    shifted_templates : np.memmap
+        The read-only bank, with shape (num_units, num_shifts, num_samples, num_channels).
+    metadata : dict
+        The selection ("dataset_paths", "template_indices", "dataset_fingerprints"), "num_shifts", "nbefore" and
+        "sampling_frequency".
+    """
+    from hybrid_injection import load_templates_from_index
+
+    cache_folder = Path(cache_folder) if cache_folder is not None else Path.cwd() / "build" / "template_banks"
+    dataset_paths = list(templates_info["dataset_path"])
+    template_indices = [int(index) for index in templates_info["template_index"]]
+    dataset_fingerprints = {path: get_dataset_fingerprint(path) for path in dict.fromkeys(dataset_paths)}
+    key = get_template_bank_key(dataset_paths, template_indices, num_shifts, dataset_fingerprints)
+    bank_path = cache_folder / f"{key}.npy"
+    metadata_path = cache_folder / f"{key}.json"
+
+    if bank_path.is_file() and metadata_path.is_file():
+        if verbose:
+            print(f"Loading cached template bank: {bank_path}")
+        return load_template_bank(bank_path)
+
+    templates_array, nbefore, sampling_frequency = load_templates_from_index(templates_info)
+    if verbose:
+        print(f"Computing template bank with {num_shifts} shifts for {len(templates_array)} templates")
+
+    # Write to temporary files and rename them, so that concurrent readers never see a partial bank
+    cache_folder.mkdir(parents=True, exist_ok=True)
+    tmp_bank_path = cache_folder / f"{key}.{os.getpid()}.tmp.npy"
+    shape = (templates_array.shape[0], num_shifts) + templates_array.shape[1:]
+    bank = np.lib.format.open_memmap(tmp_bank_path, mode="w+", dtype="float32", shape=shape)
+    compute_shifted_templates(templates_array, num_shifts, units_per_batch=units_per_batch, out=bank)
+    bank.flush()
+    del bank
+
+    metadata = dict(
+        version=template_bank_version,
+        dataset_paths=dataset_paths,
+        template_indices=template_indices,
+        dataset_fingerprints=dataset_fingerprints,
+        num_shifts=num_shifts,
+        nbefore=nbefore,
+        sampling_frequency=sampling_frequency,
+    )
+    tmp_metadata_path = cache_folder / f"{key}.{os.getpid()}.tmp.json"
+    tmp_metadata_path.write_text(json.dumps(metadata))
+    os.replace(tmp_bank_path, bank_path)
+    os.replace(tmp_metadata_path, metadata_path)
+
+    return load_template_bank(bank_path)
+
+
+def load_template_bank(bank_path):
+    """Loads a cached template bank memory-mapped (read-only) with its metadata.
+
+    Returns
+    -------
+    shifted_templates : np.memmap
+        The bank, with shape (num_units, num_shifts, num_samples, num_channels).
+    metadata : dict
+        The metadata saved with the bank (see `get_template_bank`).
+    """
+    bank_path = Path(bank_path)
+    metadata = json.loads(bank_path.with_suffix(".json").read_text())
+    shifted_templates = np.load(bank_path, mmap_mode="r")
+    return shifted_templates, metadata
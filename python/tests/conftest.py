@@ -0,0 +1,19 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+# The maintenance scripts import each other as top-level modules (they are meant to be run from the python folder)
+scripts_folder = str(Path(__file__).parents[1])
+if scripts_folder not in sys.path:
+    sys.path.insert(0, scripts_folder)
+
+
+@pytest.fixture
+def local_backend(tmp_path, monkeypatch):
+    """A `LocalBackend` in a temporary folder, set as the backend of all the tools."""
+    import storage
+
+    backend = storage.LocalBackend(tmp_path / "bucket")
+    monkeypatch.setattr(storage, "_backend", backend)
+    return backend
@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+import zarr
+
+from consolidate_datasets import open_template_dataset
+from delete_templates import delete_templates_too_few_spikes, restore_noise_levels_ibl
+from incremental_upload import load_manifest, sync_store
+from zarr_utils import add_array, create_staging_group, read_array
+
+dataset = "000409_sub-KS084_ses-test_0123abcd-0000-0000-0000-000000000000.zarr"
+spikes_per_unit = np.array([10, 80, 30, 200, 60])
+
+
+def upload_dataset(backend):
+    num_units, num_channels = len(spikes_per_unit), 4
+    rng = np.random.default_rng(0)
+    templates_array = rng.normal(size=(num_units, 20, num_channels)).astype("float32")
+    staging_store = {}
+    zarr_group = create_staging_group(staging_store)
+    add_array(zarr_group, "templates_array", templates_array)
+    add_array(zarr_group, "best_channel_index", np.zeros(num_units), dtype="uint32")
+    add_array(zarr_group, "spikes_per_unit", spikes_per_unit, dtype="uint32")
+    add_array(zarr_group, "brain_area", [f"area_{i}" for i in range(num_units)])
+    add_array(zarr_group, "peak_to_peak", np.ptp(templates_array, axis=1))
+    add_array(zarr_group, "unit_ids", np.arange(num_units))
+    add_array(zarr_group, "channel_noise_levels", np.ones(num_channels), dtype="float32")
+    zarr.consolidate_metadata(zarr_group.store)
+    dataset_store = backend.get_object_store(dataset)
+    sync_store(staging_store, dataset_store)
+    assert load_manifest(dataset_store) is not None
+    return dataset_store
+
+
+def test_delete_templates_too_few_spikes_invalidates_manifest(local_backend):
+    pytest.importorskip("pandas")
+
+    dataset_store = upload_dataset(local_backend)
+    rows = [f"{dataset},{i},{n}" for i, n in enumerate(spikes_per_unit)]
+    local_backend.put_object("templates.csv", "\n".join(["dataset,template_index,spikes_per_unit"] + rows).encode())
+
+    delete_templates_too_few_spikes(min_spikes=50, verbose=False)
+
+    assert load_manifest(dataset_store) is None
+    zarr_group = open_template_dataset(local_backend.get_url(dataset))
+    assert list(zarr_group["spikes_per_unit"][:]) == [80, 200, 60]
+    assert list(read_array(zarr_group["brain_area"])) == ["area_1", "area_3", "area_4"]
+
+
+def test_restore_noise_levels_ibl_invalidates_manifest(local_backend, monkeypatch):
+    si = pytest.importorskip("spikeinterface")
+    se = pytest.importorskip("spikeinterface.extractors")
+
+    dataset_store = upload_dataset(local_backend)
+    monkeypatch.setattr(se, "read_ibl_recording", lambda **kwargs: None)
+    monkeypatch.setattr(si, "get_noise_levels", lambda recording, **kwargs: np.full(4, 5.0, dtype="float32"))
+
+    restore_noise_levels_ibl([dataset], verbose=False)
+
+    assert load_manifest(dataset_store) is None
+    zarr_group = open_template_dataset(local_backend.get_url(dataset))
+    np.testing.assert_array_equal(zarr_group["channel_noise_levels"][:], np.full(4, 5.0))
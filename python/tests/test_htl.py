@@ -0,0 +1,28 @@
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+htl_path = Path(__file__).parents[1] / "htl.py"
+heavy_modules = ["spikeinterface", "pandas", "zarr", "boto3"]
+
+
+@pytest.mark.parametrize("args", [["--help"], ["audit", "--help"]])
+def test_htl_help_starts_quickly(args):
+    start_time = time.perf_counter()
+    result = subprocess.run([sys.executable, str(htl_path)] + args, capture_output=True, text=True)
+    elapsed = time.perf_counter() - start_time
+
+    assert result.returncode == 0, result.stderr
+    assert "usage: htl" in result.stdout
+    assert elapsed < 1.0
+
+
+@pytest.mark.parametrize("module", ["htl", "consolidate_datasets"])
+def test_import_does_not_load_heavy_dependencies(module):
+    # Imported in a fresh interpreter, as other tests of the session load these dependencies
+    code = f"import sys; import {module}; print(','.join(m for m in {heavy_modules!r} if m in sys.modules))"
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, cwd=htl_path.parent, check=True)
+    assert result.stdout.strip() == ""
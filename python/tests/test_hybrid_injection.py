@@ -0,0 +1,128 @@
+import numpy as np
+import pytest
+import zarr
+
+from hybrid_injection import get_active_channels, inject_templates
+
+num_units = 3
+template_length = 40
+nbefore = 15
+num_channels = 5
+num_samples = 1000
+chunk_size = 128
+
+
+def make_templates():
+    rng = np.random.default_rng(0)
+    return rng.normal(size=(num_units, template_length, num_channels)).astype("float32")
+
+
+def make_schedule():
+    rng = np.random.default_rng(1)
+    # Spikes at the edges of the recording and straddling the chunk borders, plus random ones
+    border_spikes = [0, 3, chunk_size - 5, chunk_size + nbefore, 2 * chunk_size, 5 * chunk_size - 30, num_samples - 2]
+    spike_samples = np.concatenate([border_spikes, rng.integers(0, num_samples, size=60)])
+    spike_unit_indices = rng.integers(0, num_units, size=len(spike_samples))
+    amplitude_factors = rng.uniform(0.5, 1.5, size=len(spike_samples)).astype("float32")
+    return spike_samples, spike_unit_indices, amplitude_factors
+
+
+def inject_naive(templates, spike_samples, spike_unit_indices, amplitude_factors, spike_shift_indices=None):
+    traces = np.zeros((num_samples, num_channels), dtype="float64")
+    for spike_index, (sample, unit_index) in enumerate(zip(spike_samples, spike_unit_indices)):
+        if spike_shift_indices is None:
+            template = templates[unit_index]
+        else:
+            template = templates[unit_index, spike_shift_indices[spike_index]]
+        for template_sample in range(template_length):
+            frame = sample - nbefore + template_sample
+            if 0 <= frame < num_samples:
+                traces[frame] += amplitude_factors[spike_index] * template[template_sample]
+    return traces
+
+
+def read_output(output_path, output_format):
+    if output_format == "binary":
+        return np.fromfile(output_path, dtype="float32").reshape(-1, num_channels)
+    return zarr.open_array(str(output_path), mode="r")[:]
+
+
+@pytest.mark.parametrize("output_format", ["binary", "zarr"])
+@pytest.mark.parametrize("n_jobs", [1, 3])
+def test_inject_templates_matches_naive_loop(tmp_path, output_format, n_jobs):
+    templates = make_templates()
+    spike_samples, spike_unit_indices, amplitude_factors = make_schedule()
+
+    output_path = inject_templates(
+        templates,
+        nbefore,
+        spike_samples,
+        spike_unit_indices,
+        num_samples=num_samples,
+        output_path=tmp_path / f"injected.{output_format}",
+        amplitude_factors=amplitude_factors,
+        output_format=output_format,
+        chunk_size=chunk_size,
+        n_jobs=n_jobs,
+        active_channel_threshold=0.0,
+    )
+
+    traces = read_output(output_path, output_format)
+    assert traces.shape == (num_samples, num_channels)
+    expected = inject_naive(templates, spike_samples, spike_unit_indices, amplitude_factors)
+    np.testing.assert_allclose(traces, expected, rtol=1e-5, atol=1e-5)
+
+
+def test_inject_templates_with_bank_and_background(tmp_path):
+    rng = np.random.default_rng(2)
+    bank = rng.normal(size=(num_units, 4, template_length, num_channels)).astype("float32")
+    spike_samples, spike_unit_indices, amplitude_factors = make_schedule()
+    spike_shift_indices = rng.integers(0, 4, size=len(spike_samples))
+    background = rng.normal(size=(num_samples, num_channels)).astype("float32")
+    background_file_path = tmp_path / "background.raw"
+    background.tofile(background_file_path)
+
+    output_path = inject_templates(
+        bank,
+        nbefore,
+        spike_samples,
+        spike_unit_indices,
+        num_samples=num_samples,
+        output_path=tmp_path / "injected.raw",
+        amplitude_factors=amplitude_factors,
+        spike_shift_indices=spike_shift_indices,
+        background_file_path=background_file_path,
+        chunk_size=chunk_size,
+        n_jobs=3,
+        active_channel_threshold=0.0,
+    )
+
+    expected = background + inject_naive(bank, spike_samples, spike_unit_indices, amplitude_factors, spike_shift_indices)
+    np.testing.assert_allclose(read_output(output_path, "binary"), expected, rtol=1e-5, atol=1e-5)
+
+
+def test_get_active_channels_relative_to_best_channel():
+    templates = np.zeros((2, template_length, num_channels), dtype="float32")
+    templates[0, nbefore] = [-100.0, -50.0, -0.5, -2.0, 0.0]
+    active_channels = get_active_channels(templates)
+    assert list(active_channels[0]) == [0, 1, 3]
+    # A flat template has no active channels
+    assert len(active_channels[1]) == 0
+    assert list(get_active_channels(templates, active_channel_threshold=0.0)[0]) == [0, 1, 2, 3]
+
+
+def test_inject_templates_rejects_short_background(tmp_path):
+    templates = make_templates()
+    background_file_path = tmp_path / "background.raw"
+    np.zeros((num_samples - 1, num_channels), dtype="float32").tofile(background_file_path)
+
+    with pytest.raises(ValueError, match="fewer than num_samples"):
+        inject_templates(
+            templates,
+            nbefore,
+            [100],
+            [0],
+            num_samples=num_samples,
+            output_path=tmp_path / "injected.raw",
+            background_file_path=background_file_path,
+        )
@@ -0,0 +1,105 @@
+import json
+import threading
+import time
+
+import numpy as np
+import zarr
+
+from incremental_upload import load_manifest, manifest_key, sync_store
+from zarr_utils import add_array, create_staging_group
+
+
+def make_staging_store(channel_noise_levels=None):
+    rng = np.random.default_rng(0)
+    staging_store = {}
+    zarr_group = create_staging_group(staging_store)
+    add_array(zarr_group, "templates_array", rng.normal(size=(6, 20, 4)).astype("float32"), chunks=(2, 20, 4))
+    add_array(zarr_group, "brain_area", ["CA1", "VISp", "CA1", "LP", "PO", "CA3"])
+    if channel_noise_levels is None:
+        channel_noise_levels = np.ones(4)
+    add_array(zarr_group, "channel_noise_levels", channel_noise_levels, dtype="float32")
+    zarr.consolidate_metadata(zarr_group.store)
+    return staging_store
+
+
+class ConcurrencyStore(dict):
+    """In-memory store that records the maximum number of concurrent writes."""
+
+    def __init__(self, max_concurrency=None):
+        super().__init__()
+        self.max_concurrency = max_concurrency
+        self.max_active_writes = 0
+        self._active_writes = 0
+        self._lock = threading.Lock()
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._active_writes += 1
+            self.max_active_writes = max(self.max_active_writes, self._active_writes)
+        time.sleep(0.005)
+        super().__setitem__(key, value)
+        with self._lock:
+            self._active_writes -= 1
+
+
+def test_sync_store_caps_writes_in_flight_to_store_concurrency():
+    staging_store = {f"templates_array/{i}.0.0": bytes([i]) for i in range(32)}
+    remote_store = ConcurrencyStore(max_concurrency=3)
+
+    sync_store(staging_store, remote_store, max_in_flight=16)
+
+    assert 1 < remote_store.max_active_writes <= 3
+    assert all(remote_store[key] == value for key, value in staging_store.items())
+
+
+def test_second_identical_sync_uploads_nothing():
+    remote_store = {}
+    first_summary = sync_store(make_staging_store(), remote_store)
+    assert len(first_summary["uploaded"]) > 0
+    assert load_manifest(remote_store) is not None
+
+    remote_store_before = dict(remote_store)
+    second_summary = sync_store(make_staging_store(), remote_store)
+    assert second_summary["uploaded"] == []
+    assert second_summary["deleted"] == []
+    assert remote_store == remote_store_before
+
+
+def test_changing_noise_levels_uploads_one_chunk():
+    remote_store = {}
+    sync_store(make_staging_store(), remote_store)
+
+    staging_store = make_staging_store(channel_noise_levels=np.full(4, 2.0))
+    summary = sync_store(staging_store, remote_store)
+
+    # Only the data chunk changes: the array metadata and the consolidated metadata are identical
+    assert summary["uploaded"] == ["channel_noise_levels/0"]
+    assert summary["deleted"] == []
+    assert remote_store["channel_noise_levels/0"] == staging_store["channel_noise_levels/0"].to_bytes()
+
+
+def test_sync_without_manifest_deletes_stale_keys():
+    remote_store = {
+        "old_array/.zarray": b"{}",
+        "old_array/0": b"stale",
+        "brain_area/.zarray": b"{}",
+    }
+    staging_store = make_staging_store()
+    summary = sync_store(staging_store, remote_store)
+
+    assert sorted(summary["deleted"]) == ["old_array/.zarray", "old_array/0"]
+    assert sorted(summary["uploaded"]) == sorted(staging_store)
+    assert sorted(remote_store) == sorted(list(staging_store) + [manifest_key])
+
+
+def test_load_manifest():
+    remote_store = {}
+    assert load_manifest(remote_store) is None
+
+    staging_store = make_staging_store()
+    sync_store(staging_store, remote_store)
+    assert sorted(load_manifest(remote_store)) == sorted(staging_store)
+
+    # Manifests of another version are ignored
+    remote_store[manifest_key] = json.dumps(dict(version=0, hashes={})).encode()
+    assert load_manifest(remote_store) is None
@@ -0,0 +1,112 @@
+import threading
+import time
+from collections import namedtuple
+
+import pytest
+
+import pipeline
+from pipeline import DiskSpaceGate, run_pipeline
+
+DiskUsage = namedtuple("DiskUsage", ["total", "used", "free"])
+
+
+def test_run_pipeline_with_several_workers_per_stage():
+    active = {"square": 0}
+    max_active = {"square": 0}
+    lock = threading.Lock()
+
+    def square(item):
+        with lock:
+            active["square"] += 1
+            max_active["square"] = max(max_active["square"], active["square"])
+        time.sleep(0.01)
+        with lock:
+            active["square"] -= 1
+        return item**2
+
+    stages = [
+        dict(name="square", func=square, num_workers=3),
+        dict(name="increment", func=lambda item: item + 1, num_workers=2),
+    ]
+    results, failures = run_pipeline(range(20), stages)
+
+    # Every item reaches the end of the pipeline once, and all workers see the end of the stream
+    assert sorted(results) == sorted(item**2 + 1 for item in range(20))
+    assert failures == []
+    assert max_active["square"] > 1
+
+
+def test_run_pipeline_drops_failed_items():
+    def check(item):
+        if item % 3 == 0:
+            raise ValueError(f"bad item {item}")
+        return item
+
+    stages = [
+        dict(name="check", func=check, num_workers=2),
+        dict(name="skip", func=lambda item: None if item == 4 else item),
+    ]
+    results, failures = run_pipeline(range(10), stages)
+
+    assert sorted(results) == [1, 2, 5, 7, 8]
+    assert sorted(failure["item"] for failure in failures) == [0, 3, 6, 9]
+    assert all(failure["stage"] == "check" for failure in failures)
+    assert all(isinstance(failure["error"], ValueError) for failure in failures)
+
+
+def test_run_pipeline_expand():
+    stages = [
+        dict(name="split", func=lambda item: [item] * item, expand=True),
+        dict(name="double", func=lambda item: 2 * item, num_workers=2),
+    ]
+    results, failures = run_pipeline([1, 2, 3], stages)
+
+    assert sorted(results) == [2, 4, 4, 6, 6, 6]
+    assert failures == []
+
+
+def test_disk_space_gate_blocks_until_release(tmp_path, monkeypatch):
+    monkeypatch.setattr(pipeline.shutil, "disk_usage", lambda path: DiskUsage(1000, 0, 1000))
+    gate = DiskSpaceGate(tmp_path, max_cache_bytes=150, poll_interval=0.01)
+    gate.acquire(100)
+    gate.mark_written(100)
+
+    admitted = threading.Event()
+
+    def acquire_second_copy():
+        gate.acquire(100)
+        admitted.set()
+
+    thread = threading.Thread(target=acquire_second_copy, daemon=True)
+    thread.start()
+    # The second copy does not fit with the first one
+    assert not admitted.wait(timeout=0.1)
+
+    gate.release(100)
+    assert admitted.wait(timeout=1.0)
+    thread.join(timeout=1.0)
+
+
+def test_disk_space_gate_accounts_for_pending_copies(tmp_path, monkeypatch):
+    monkeypatch.setattr(pipeline.shutil, "disk_usage", lambda path: DiskUsage(1000, 800, 200))
+    gate = DiskSpaceGate(tmp_path, min_free_bytes=50, poll_interval=0.01)
+    gate.acquire(100)
+
+    # The first copy is not written yet, so it is not reflected in the free space reported by the disk
+    admitted = threading.Event()
+    thread = threading.Thread(target=lambda: (gate.acquire(100), admitted.set()), daemon=True)
+    thread.start()
+    assert not admitted.wait(timeout=0.1)
+
+    gate.mark_written(100)
+    gate.release(100)
+    assert admitted.wait(timeout=1.0)
+    thread.join(timeout=1.0)
+
+
+def test_disk_space_gate_raises_when_copy_never_fits(tmp_path, monkeypatch):
+    monkeypatch.setattr(pipeline.shutil, "disk_usage", lambda path: DiskUsage(1000, 900, 100))
+    gate = DiskSpaceGate(tmp_path, min_free_bytes=50)
+
+    with pytest.raises(OSError, match="Not enough disk space"):
+        gate.acquire(100)
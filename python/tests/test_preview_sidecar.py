@@ -0,0 +1,84 @@
+import io
+
+import numpy as np
+import pytest
+
+from preview_sidecar import (
+    encode_preview_sidecar,
+    get_preview_active_channels,
+    get_preview_file_name,
+    read_preview_header,
+    read_preview_unit,
+)
+
+
+def make_units(channel_layouts, num_units=5, num_samples=30):
+    rng = np.random.default_rng(0)
+    units = []
+    for unit_index in range(num_units):
+        layout_index = unit_index % len(channel_layouts)
+        num_channels = len(channel_layouts[layout_index])
+        best_channel = unit_index % num_channels
+        active_channels = get_preview_active_channels(rng.uniform(0, 300, size=num_channels), best_channel)
+        units.append(
+            dict(
+                layout_index=layout_index,
+                best_channel=best_channel,
+                unit_id=f"unit_{unit_index}",
+                best_channel_id=f"AP{best_channel}",
+                # Labels of every length modulo 4, and non-ASCII characters
+                brain_area="CA1" + "µ" * unit_index,
+                spikes_per_unit=100 + unit_index,
+                amplitude_uv=float(rng.uniform(50, 300)),
+                signal_to_noise_ratio=float("nan") if unit_index == 0 else float(rng.uniform(1, 20)),
+                nbefore=10,
+                sampling_frequency=30_000.0,
+                active_channels=active_channels,
+                waveforms=rng.normal(size=(len(active_channels), num_samples + unit_index)),
+            )
+        )
+    return units
+
+
+def test_preview_sidecar_round_trip():
+    channel_layouts = [np.column_stack([np.zeros(4), np.arange(4) * 20.0]), np.arange(12.0).reshape(6, 2)]
+    units = make_units(channel_layouts)
+    file = io.BytesIO(encode_preview_sidecar(channel_layouts, units))
+
+    header = read_preview_header(file)
+    assert header["version"] == 2
+    assert header["num_units"] == len(units)
+    assert len(header["channel_layouts"]) == len(channel_layouts)
+    for channel_locations, expected in zip(header["channel_layouts"], channel_layouts):
+        np.testing.assert_array_equal(channel_locations, expected.astype("float32"))
+    # Records start on 4-byte boundaries, so that the viewer can view their values as typed arrays
+    assert all(offset % 4 == 0 for offset in header["record_offsets"])
+
+    # Read the units out of order, as the viewer would
+    for unit_index in [3, 0, 4, 1, 2]:
+        unit = read_preview_unit(file, header, unit_index)
+        expected = units[unit_index]
+        for key in ("layout_index", "best_channel", "unit_id", "best_channel_id", "brain_area", "spikes_per_unit"):
+            assert unit[key] == expected[key]
+        assert unit["nbefore"] == expected["nbefore"]
+        assert unit["amplitude_uv"] == pytest.approx(expected["amplitude_uv"], rel=1e-6)
+        assert unit["sampling_frequency"] == expected["sampling_frequency"]
+        np.testing.assert_array_equal(unit["active_channels"], expected["active_channels"])
+        np.testing.assert_array_equal(unit["waveforms"], expected["waveforms"].astype("float32"))
+    assert np.isnan(read_preview_unit(file, header, 0)["signal_to_noise_ratio"])
+
+
+def test_get_preview_active_channels():
+    peak_to_peak = np.array([100.0, 9.9, 10.0, 50.0, 0.0])
+    assert list(get_preview_active_channels(peak_to_peak, best_channel=0)) == [0, 2, 3]
+    # The best channel is always plotted, even if the stored best channel is not the largest one
+    assert list(get_preview_active_channels(peak_to_peak, best_channel=4)) == [0, 1, 2, 3, 4]
+
+
+def test_read_preview_header_rejects_other_files():
+    with pytest.raises(ValueError, match="Not a template preview sidecar"):
+        read_preview_header(io.BytesIO(b"\x00" * 64))
+
+
+def test_get_preview_file_name():
+    assert get_preview_file_name("Neuropixels 1.0") == "Neuropixels_1.0.htlp"
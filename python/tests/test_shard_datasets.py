@@ -0,0 +1,101 @@
+import numpy as np
+import pytest
+import zarr
+
+from consolidate_datasets import open_template_dataset
+from incremental_upload import sync_store
+from shard_datasets import encode_sharded_staging_store, migrate_datasets_to_sharded_layout
+import storage
+from storage import LocalBackend
+from zarr_utils import add_array, create_staging_group, read_array
+
+
+def make_staging_store(num_units=10, num_samples=20, num_channels=4):
+    rng = np.random.default_rng(0)
+    staging_store = {}
+    zarr_group = create_staging_group(staging_store)
+    zarr_group.attrs["sampling_frequency"] = 30_000.0
+    add_array(zarr_group, "templates_array", rng.normal(size=(num_units, num_samples, num_channels)).astype("float32"))
+    add_array(zarr_group, "peak_to_peak", rng.random((num_units, num_channels)).astype("float32"))
+    add_array(zarr_group, "unit_ids", np.arange(num_units))
+    add_array(zarr_group, "brain_area", ["CA1"] * num_units)
+    probe_group = zarr_group.create_group("probe")
+    add_array(probe_group, "x", np.zeros(num_channels))
+    probe_group.create_group("annotations").attrs["model_name"] = "Neuropixels 1.0"
+    zarr.consolidate_metadata(zarr_group.store)
+    return staging_store
+
+
+def test_encode_sharded_staging_store():
+    staging_store = make_staging_store(num_units=10)
+    sharded_store = encode_sharded_staging_store(staging_store, units_per_shard=4)
+
+    source_group = zarr.open_consolidated(zarr.storage.MemoryStore(staging_store), mode="r")
+    sharded_group = zarr.open_consolidated(zarr.storage.MemoryStore(sharded_store), mode="r")
+    assert sharded_group.metadata.zarr_format == 3
+    assert sharded_group["templates_array"].chunks == (1, 20, 4)
+    assert sharded_group["templates_array"].shards == (4, 20, 4)
+    np.testing.assert_array_equal(sharded_group["templates_array"][:], source_group["templates_array"][:])
+    assert list(read_array(sharded_group["brain_area"])) == ["CA1"] * 10
+    assert sharded_group["probe"]["annotations"].attrs["model_name"] == "Neuropixels 1.0"
+
+
+class RecordingBackend(LocalBackend):
+    """Local backend that records the order of the writes and deletes."""
+
+    def __init__(self, root):
+        super().__init__(root)
+        self.events = []
+
+    def put_object(self, key, data):
+        self.events.append(("put", key))
+        super().put_object(key, data)
+
+    def delete_object(self, key):
+        self.events.append(("delete", key))
+        super().delete_object(key)
+
+
+@pytest.fixture
+def recording_backend(tmp_path, monkeypatch):
+    backend = RecordingBackend(tmp_path)
+    monkeypatch.setattr(storage, "_backend", backend)
+    return backend
+
+
+def test_migrate_dataset_writes_over_original(recording_backend):
+    local_backend = recording_backend
+    dataset = "dataset.zarr"
+    staging_store = make_staging_store(num_units=10)
+    sync_store(staging_store, local_backend.get_object_store(dataset), max_in_flight=1)
+    local_backend.events.clear()
+
+    migrated_datasets = migrate_datasets_to_sharded_layout(units_per_shard=4)
+    assert migrated_datasets == [dataset]
+
+    sharded_group = open_template_dataset(local_backend.get_url(dataset))
+    assert sharded_group.metadata.zarr_format == 3
+    assert sharded_group["templates_array"].shards == (4, 20, 4)
+    source_group = zarr.open_consolidated(zarr.storage.MemoryStore(staging_store), mode="r")
+    np.testing.assert_array_equal(sharded_group["templates_array"][:], source_group["templates_array"][:])
+
+    # No Zarr v2 key is left, and none was deleted before the root zarr.json of the sharded copy was written
+    keys = list(local_backend.get_object_store(dataset))
+    assert not any(key.rsplit("/", 1)[-1] in (".zarray", ".zattrs", ".zgroup", ".zmetadata") for key in keys)
+    root_metadata_event = local_backend.events.index(("put", f"{dataset}/zarr.json"))
+    assert ("delete", f"{dataset}/.zmetadata") in local_backend.events[root_metadata_event:]
+    assert not any(
+        event == "delete" and not key.endswith(".htl_manifest.json")
+        for event, key in local_backend.events[:root_metadata_event]
+    )
+
+    # Sharded datasets are skipped
+    assert migrate_datasets_to_sharded_layout(units_per_shard=4) == []
+
+
+def test_migrate_skips_viewer_dataset_unless_given(local_backend):
+    for dataset in ["dataset.zarr", "test_templates.zarr"]:
+        sync_store(make_staging_store(num_units=4), local_backend.get_object_store(dataset))
+
+    assert migrate_datasets_to_sharded_layout(dry_run=True) == ["dataset.zarr"]
+    assert migrate_datasets_to_sharded_layout(["test_templates.zarr"], dry_run=True) == ["test_templates.zarr"]
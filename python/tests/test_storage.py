@@ -0,0 +1,147 @@
+import pytest
+
+import storage
+from storage import LocalBackend, S3Backend, get_backend, mirror_datasets
+
+
+def test_s3_connection_pool_covers_multipart_uploads():
+    backend = S3Backend(max_concurrency=8, multipart_max_concurrency=4)
+    assert backend._config_kwargs["max_pool_connections"] == 32
+    assert backend.get_object_store("dataset.zarr").max_concurrency == 8
+
+
+def test_local_object_store(tmp_path):
+    store = LocalBackend(tmp_path).get_object_store("dataset.zarr")
+    assert store.max_concurrency is None
+
+    store["templates_array/0.0.0"] = b"chunk"
+    store["zarr.json"] = b"{}"
+    assert sorted(store) == ["templates_array/0.0.0", "zarr.json"]
+    assert store["templates_array/0.0.0"] == b"chunk"
+    del store["zarr.json"]
+    assert list(store) == ["templates_array/0.0.0"]
+
+
+def fill_backend(backend):
+    backend.put_object("dataset.zarr/zarr.json", b"{}")
+    backend.put_object("dataset.zarr/templates_array/c/0/0/0", b"chunk")
+    # Shares the prefix "dataset.zarr" without the separator
+    backend.put_object("dataset.zarr_other/zarr.json", b"{}")
+    backend.put_object("other.zarr/.zmetadata", b"{}")
+    backend.put_object("templates.csv", b"dataset,template_index\n")
+    backend.put_object("previews/Neuropixels_1.0.htlp", b"preview")
+
+
+def test_local_backend_listing(tmp_path):
+    backend = LocalBackend(tmp_path / "bucket")
+    assert backend.list_datasets() == []
+    assert list(backend.list_objects("dataset.zarr/")) == []
+
+    fill_backend(backend)
+    # Only the folders named "*.zarr" are datasets
+    assert sorted(backend.list_datasets()) == ["dataset.zarr", "other.zarr"]
+    assert list(backend.list_objects("dataset.zarr/")) == [
+        ("dataset.zarr/templates_array/c/0/0/0", 5),
+        ("dataset.zarr/zarr.json", 2),
+    ]
+    # As on S3, a prefix without separator also matches the keys of sibling folders
+    assert [key for key, _ in backend.list_objects("dataset.zarr")] == [
+        "dataset.zarr/templates_array/c/0/0/0",
+        "dataset.zarr/zarr.json",
+        "dataset.zarr_other/zarr.json",
+    ]
+    assert backend.exists("templates.csv") and not backend.exists("dataset.zarr")
+    with pytest.raises(KeyError):
+        backend.get_object("missing.csv")
+
+
+def test_local_backend_delete_prefix_keeps_siblings(tmp_path):
+    backend = LocalBackend(tmp_path / "bucket")
+    fill_backend(backend)
+
+    backend.delete_prefix("dataset.zarr/")
+    assert not (backend.root / "dataset.zarr").exists()
+    assert list(backend.list_objects("dataset.zarr/")) == []
+    assert backend.get_object("dataset.zarr_other/zarr.json") == b"{}"
+    assert backend.list_datasets() == ["other.zarr"]
+    with pytest.raises(KeyError):
+        backend.delete_object("dataset.zarr/zarr.json")
+
+
+def get_objects(backend, prefix=""):
+    return {key: backend.get_object(key) for key, _ in backend.list_objects(prefix)}
+
+
+def test_mirror_datasets_round_trip(tmp_path):
+    source = LocalBackend(tmp_path / "source")
+    fill_backend(source)
+
+    destination = LocalBackend(tmp_path / "mirror")
+    num_bytes = mirror_datasets(source, destination)
+    # The datasets and the index, but neither the previews nor the folders that are not datasets
+    expected = get_objects(source, "dataset.zarr/") | get_objects(source, "other.zarr/")
+    expected["templates.csv"] = source.get_object("templates.csv")
+    assert get_objects(destination) == expected
+    assert num_bytes == sum(len(data) for data in expected.values())
+
+    # And back, for a subset of the datasets and without the index
+    round_trip = LocalBackend(tmp_path / "round_trip")
+    mirror_datasets(destination, round_trip, datasets=["dataset.zarr"], include_index=False)
+    assert get_objects(round_trip) == get_objects(source, "dataset.zarr/")
+
+
+@pytest.fixture
+def backend_environment(monkeypatch):
+    """Clears the backend of the process and the storage environment variables."""
+    monkeypatch.setattr(storage, "_backend", None)
+    for name in ("HTL_STORAGE", "HTL_LOCAL_ROOT", "HTL_BUCKET", "HTL_REGION", "HTL_MAX_CONCURRENCY", "HTL_MAX_RETRIES"):
+        monkeypatch.delenv(name, raising=False)
+    return monkeypatch
+
+
+def test_get_backend_defaults_to_s3(backend_environment):
+    backend = get_backend()
+    assert isinstance(backend, S3Backend)
+    assert (backend.bucket_name, backend.region_name) == (storage.default_bucket_name, storage.default_region_name)
+    assert (backend.max_concurrency, backend.max_retries) == (storage.default_max_concurrency, storage.default_max_retries)
+    # The backend is created once per process
+    assert get_backend() is backend
+
+
+def test_get_backend_s3_from_environment(backend_environment):
+    backend_environment.setenv("HTL_STORAGE", "s3")
+    backend_environment.setenv("HTL_BUCKET", "my-bucket")
+    backend_environment.setenv("HTL_REGION", "eu-west-1")
+    backend_environment.setenv("HTL_MAX_CONCURRENCY", "4")
+    backend_environment.setenv("HTL_MAX_RETRIES", "3")
+
+    backend = get_backend()
+    assert (backend.bucket_name, backend.region_name) == ("my-bucket", "eu-west-1")
+    assert (backend.max_concurrency, backend.max_retries) == (4, 3)
+
+
+def test_get_backend_local_from_environment(backend_environment, tmp_path):
+    backend_environment.setenv("HTL_STORAGE", "local")
+    backend_environment.setenv("HTL_LOCAL_ROOT", str(tmp_path))
+
+    backend = get_backend()
+    assert isinstance(backend, LocalBackend)
+    assert backend.root == tmp_path
+
+
+@pytest.mark.parametrize(
+    "environment, message",
+    [
+        (dict(HTL_STORAGE="local"), "HTL_LOCAL_ROOT must be set"),
+        (dict(HTL_STORAGE="gcs"), "HTL_STORAGE must be 's3' or 'local', not 'gcs'"),
+        (dict(HTL_MAX_CONCURRENCY="many"), "invalid literal for int"),
+    ],
+)
+def test_get_backend_rejects_invalid_environment(backend_environment, environment, message):
+    for name, value in environment.items():
+        backend_environment.setenv(name, value)
+
+    with pytest.raises(ValueError, match=message):
+        get_backend()
+    # A failed configuration is not cached
+    assert storage._backend is None
@@ -0,0 +1,98 @@
+import numpy as np
+import zarr
+
+import hybrid_injection
+from incremental_upload import sync_store
+from template_bank import compute_shifted_templates, get_template_bank, load_template_bank
+from zarr_utils import add_array, create_staging_group
+
+
+def make_gaussian_templates(num_units=3, num_samples=64, num_channels=2):
+    # Smooth pulses far from the edges, so that their centroids are not biased by the cropped tails
+    times = np.arange(num_samples)
+    centers = [30.0, 31.3, 32.7][:num_units]
+    templates = np.zeros((num_units, num_samples, num_channels), dtype="float32")
+    for unit_index, center in enumerate(centers):
+        pulse = np.exp(-0.5 * ((times - center) / 2.0) ** 2)
+        templates[unit_index] = pulse[:, None] * np.arange(1, num_channels + 1)[None, :]
+    return templates
+
+
+def get_centroids(templates):
+    times = np.arange(templates.shape[-2])
+    return (templates * times[:, None]).sum(axis=-2) / templates.sum(axis=-2)
+
+
+def test_shift_zero_is_input_template():
+    templates = make_gaussian_templates()
+    shifted_templates = compute_shifted_templates(templates, num_shifts=5, units_per_batch=2)
+
+    assert shifted_templates.shape == (3, 5) + templates.shape[1:]
+    np.testing.assert_allclose(shifted_templates[:, 0], templates, atol=1e-5)
+
+
+def test_shifted_centroid_moves_by_fraction_of_sample():
+    num_shifts = 4
+    templates = make_gaussian_templates()
+    shifted_templates = compute_shifted_templates(templates, num_shifts=num_shifts)
+
+    centroids = get_centroids(templates)
+    for k in range(num_shifts):
+        np.testing.assert_allclose(get_centroids(shifted_templates[:, k]), centroids + k / num_shifts, atol=1e-4)
+
+
+def test_shift_does_not_wrap_around():
+    templates = np.zeros((1, 64, 1), dtype="float32")
+    templates[0, -1] = 1.0
+    shifted_templates = compute_shifted_templates(templates, num_shifts=2)
+
+    # The end of the template leaks into its first samples only through the decaying tail of the interpolation
+    assert np.abs(shifted_templates[0, 1, :4]).max() < 0.01
+
+
+def upload_dataset(backend, dataset, num_units):
+    staging_store = {}
+    zarr_group = create_staging_group(staging_store)
+    add_array(zarr_group, "templates_array", np.zeros((num_units, 64, 2), dtype="float32"))
+    zarr.consolidate_metadata(zarr_group.store)
+    sync_store(staging_store, backend.get_object_store(dataset))
+    return backend.get_url(dataset)
+
+
+def test_get_template_bank_cache(local_backend, tmp_path, monkeypatch):
+    dataset_path = upload_dataset(local_backend, "dataset.zarr", num_units=3)
+    templates_info = dict(dataset_path=[dataset_path, dataset_path], template_index=[2, 0])
+    templates = make_gaussian_templates(num_units=2)
+    loaded_selections = []
+
+    def load_templates_from_index(templates_info):
+        loaded_selections.append(list(templates_info["template_index"]))
+        return templates, 30, 30_000.0
+
+    monkeypatch.setattr(hybrid_injection, "load_templates_from_index", load_templates_from_index)
+    cache_folder = tmp_path / "banks"
+
+    bank, metadata = get_template_bank(templates_info, num_shifts=3, cache_folder=cache_folder)
+    assert isinstance(bank, np.memmap)
+    assert not bank.flags.writeable
+    assert bank.shape == (2, 3, 64, 2)
+    np.testing.assert_allclose(bank[:, 0], templates, atol=1e-5)
+    assert metadata["nbefore"] == 30
+    assert metadata["template_indices"] == [2, 0]
+
+    # A second request for the same selection is served from the cache
+    cached_bank, cached_metadata = get_template_bank(templates_info, num_shifts=3, cache_folder=cache_folder)
+    assert loaded_selections == [[2, 0]]
+    np.testing.assert_array_equal(cached_bank, bank)
+    assert cached_metadata == metadata
+    reloaded_bank, _ = load_template_bank(cached_bank.filename)
+    np.testing.assert_array_equal(reloaded_bank, bank)
+
+    # Another number of shifts, or a dataset whose units changed in place, gives another bank
+    get_template_bank(templates_info, num_shifts=4, cache_folder=cache_folder)
+    assert len(loaded_selections) == 2
+    upload_dataset(local_backend, "dataset.zarr", num_units=2)
+    _, new_metadata = get_template_bank(templates_info, num_shifts=3, cache_folder=cache_folder)
+    assert len(loaded_selections) == 3
+    assert new_metadata["dataset_fingerprints"] != metadata["dataset_fingerprints"]
+    assert len(list(cache_folder.glob("*.npy"))) == 3
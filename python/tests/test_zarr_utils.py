@@ -0,0 +1,56 @@
+import json
+
+import numpy as np
+import zarr
+
+from zarr_utils import add_array, create_staging_group, read_array, rewrite_array
+
+
+def test_staging_group_uses_default_layout():
+    staging_store = {}
+    zarr_group = create_staging_group(staging_store)
+    add_array(zarr_group, "brain_area", ["CA1", "VISp", "unknown"])
+    add_array(zarr_group, "spikes_per_unit", [10, 20, 30], dtype="uint32")
+    zarr.consolidate_metadata(zarr_group.store)
+
+    # Strings are stored as variable-length UTF-8, as with the zarr 2 VLenUTF8 object codec
+    brain_area_metadata = json.loads(staging_store["brain_area/.zarray"].to_bytes())
+    assert brain_area_metadata["zarr_format"] == 2
+    assert brain_area_metadata["filters"] == [{"id": "vlen-utf8"}]
+
+    zarr_root = zarr.open_consolidated(zarr.storage.MemoryStore(staging_store), mode="r")
+    assert list(read_array(zarr_root["brain_area"])) == ["CA1", "VISp", "unknown"]
+    assert zarr_root["spikes_per_unit"].dtype == np.uint32
+
+
+def test_rewrite_array_keeps_encoding():
+    zarr_group = zarr.group(store={}, zarr_format=3)
+    templates_array = np.random.default_rng(0).normal(size=(10, 20, 4)).astype("float32")
+    add_array(zarr_group, "templates_array", templates_array, chunks=(1, 20, 4), shards=(4, 20, 4))
+    add_array(zarr_group, "brain_area", [f"area_{i}" for i in range(10)], chunks=(1,), shards=(4,))
+    zarr_group["templates_array"].attrs["units"] = "uV"
+
+    unit_indices_to_keep = np.array([0, 3, 4, 9])
+    rewrite_array(zarr_group, "templates_array", templates_array[unit_indices_to_keep])
+    rewrite_array(zarr_group, "brain_area", read_array(zarr_group["brain_area"])[unit_indices_to_keep])
+
+    rewritten = zarr_group["templates_array"]
+    assert rewritten.shape == (4, 20, 4)
+    assert rewritten.chunks == (1, 20, 4)
+    assert rewritten.shards == (4, 20, 4)
+    assert rewritten.attrs["units"] == "uV"
+    np.testing.assert_array_equal(rewritten[...], templates_array[unit_indices_to_keep])
+    assert zarr_group["brain_area"].shards == (4,)
+    assert list(read_array(zarr_group["brain_area"])) == ["area_0", "area_3", "area_4", "area_9"]
+
+    # Arrays in the default layout keep their chunks and string codec
+    staging_store = {}
+    zarr_group = create_staging_group(staging_store)
+    add_array(zarr_group, "spikes_per_unit", np.arange(10), dtype="uint32", chunks=(3,))
+    add_array(zarr_group, "brain_area", [f"area_{i}" for i in range(10)])
+    rewrite_array(zarr_group, "spikes_per_unit", np.arange(4))
+    rewrite_array(zarr_group, "brain_area", ["a", "b"])
+    assert zarr_group["spikes_per_unit"].chunks == (3,)
+    assert zarr_group["spikes_per_unit"].dtype == np.uint32
+    assert json.loads(staging_store["brain_area/.zarray"].to_bytes())["filters"] == [{"id": "vlen-utf8"}]
+    assert list(read_array(zarr_group["brain_area"])) == ["a", "b"]
@@ -1,25 +1,23 @@
 """
 This script constructs and uploads the templates from the International Brain Laboratory (IBL) datasets
-available from DANDI (https://dandiarchive.org/dandiset/000409?search=IBL&pos=3). 
+available from DANDI (https://dandiarchive.org/dandiset/000409?search=IBL&pos=3).
 
 Templates are extracted by combining the raw data from the NWB files on DANDI with the spike trains form
 the Alyx ONE database. Only the units that passed the IBL quality control are used.
-To minimize the amount of drift in the templates, only the last 30 minutes of the recording are used. 
-The raw recordings are pre-processed with a high-pass filter and a common median reference prior to 
+To minimize the amount of drift in the templates, only the last 30 minutes of the recording are used.
+The raw recordings are pre-processed with a high-pass filter and a common median reference prior to
 template extraction. Units with less than 50 spikes are excluded from the template database.
 
-Once the templates are constructed they are saved to a Zarr file which is then uploaded to 
+Once the templates are constructed they are saved to a Zarr file which is then uploaded to
 "spikeinterface-template-database" bucket (hosted by CatalystNeuro).
 """
 
 from pathlib import Path
+import shutil
 
 import numpy as np
-import s3fs
 import zarr
 import time
-import os
-import numcodecs
 
 from dandi.dandiapi import DandiAPIClient
 
@@ -38,7 +36,11 @@ from spikeinterface.preprocessing import (
 
 from one.api import ONE
 
-from consolidate_datasets import list_zarr_directories
+from incremental_upload import sync_store
+from shard_datasets import encode_sharded_staging_store
+from zarr_utils import add_array, create_staging_group
+from storage import LocalBackend, get_backend
+from pipeline import DiskSpaceGate, run_pipeline
 
 
 def find_channels_with_max_peak_to_peak_vectorized(templates):
@@ -61,45 +63,63 @@ def find_channels_with_max_peak_to_peak_vectorized(templates):
     return best_channels
 
 
-# AWS credentials
-aws_access_key_id = os.environ.get("AWS_ACCESS_KEY_ID")
-aws_secret_access_key = os.environ.get("AWS_SECRET_ACCESS_KEY")
-bucket_name = "spikeinterface-template-database"
-client_kwargs = {"region_name": "us-east-2"}
-
 # Parameters
+dandiset_id = "000409"
 minutes_by_the_end = 30  # How many minutes in the end of the recording to use for templates
 min_spikes_per_unit = 50
 upload_data = True
 overwite = False
 verbose = True
+sharded = False  # Write datasets in the sharded (Zarr v3) layout
+units_per_shard = 64
+
+# Pipelined execution: session k + 1 is downloaded while session k is computed and session k - 1 is uploaded
+pipelined = False
+num_download_workers = 1
+num_compute_workers = 1
+num_upload_workers = 1
+min_free_disk_gb = 20  # Free disk space to preserve when making local copies of the recordings
+max_local_copies_gb = None  # Maximum total size of the local copies (None for no limit)
 
 # Test data
 do_testing_data = False
 test_path = "sub-KS051/sub-KS051_ses-0a018f12-ee06-4b11-97aa-bbbff5448e9f_behavior+ecephys+image.nwb"
 
-ONE.setup(base_url="https://openalyx.internationalbrainlab.org", silent=True)
-one_instance = ONE(password="international")
 
-client = DandiAPIClient.for_dandi_instance("dandi")
-dandiset_id = "000409"
-dandiset = client.get_dandiset(dandiset_id)
+def get_one_instance():
+    ONE.setup(base_url="https://openalyx.internationalbrainlab.org", silent=True)
+    return ONE(password="international")
 
-has_ecephy_data = lambda path: path.endswith(".nwb") and "ecephys" in path
-dandiset_paths = [asset.path for asset in dandiset.get_assets() if has_ecephy_data(asset.path)]
-dandiset_paths.sort()
-dandiset_paths = [path for path in dandiset_paths if "KS" in path]
 
-if do_testing_data:
-    dandiset_paths = [test_path]
+def get_dandiset_paths(dandiset, do_testing_data=False):
+    """Returns the paths of the IBL assets with ecephys data in the dandiset, in random order."""
+    if do_testing_data:
+        return [test_path]
 
-# Load already processed datasets
-zarr_datasets = list_zarr_directories(bucket_name=bucket_name)
-if verbose:
-    print(f"Found {len(zarr_datasets)} datasets already processed")
+    has_ecephy_data = lambda path: path.endswith(".nwb") and "ecephys" in path
+    dandiset_paths = [asset.path for asset in dandiset.get_assets() if has_ecephy_data(asset.path)]
+    dandiset_paths.sort()
+    dandiset_paths = [path for path in dandiset_paths if "KS" in path]
+
+    return list(np.random.choice(dandiset_paths, size=len(dandiset_paths), replace=False))
+
+
+def resolve_sessions(
+    asset_path,
+    dandiset,
+    one_instance,
+    zarr_datasets,
+    overwrite=False,
+    do_testing_data=False,
+    verbose=True,
+):
+    """
+    Resolves the recording and sorting of each probe (AP electrical series) in a DANDI asset.
 
-dandiset_paths = np.random.choice(dandiset_paths, size=len(dandiset_paths), replace=False)
-for asset_path in dandiset_paths:
+    Returns a list of sessions, i.e. dictionaries with the sliced recording and sorting and the metadata
+    needed by the following stages. Sessions whose dataset was already processed are skipped unless
+    `overwrite` is True.
+    """
     if verbose:
         print("----------------------------------------------------------")
         print("----------------------------------------------------------")
@@ -115,6 +135,7 @@ for asset_path in dandiset_paths:
         file_path=file_path, stream_mode="remfile"
     )
     electrical_series_paths_ap = [path for path in electrical_series_paths if "Ap" in path.split("/")[-1]]
+    sessions = []
     for electrical_series_path in electrical_series_paths_ap:
         print(f"{electrical_series_path=}")
 
@@ -153,7 +174,7 @@ for asset_path in dandiset_paths:
             dandi_name = asset_path.split("/")[-1].split(".")[0]
             dataset_name = f"{dandiset_id}_{dandi_name}_{sorting_pid}.zarr"
 
-        if dataset_name in zarr_datasets and not overwite:
+        if dataset_name in zarr_datasets and not overwrite:
             if verbose:
                 print(f"Dataset {dataset_name} already processed, skipping")
             continue
@@ -193,145 +214,325 @@ for asset_path in dandiset_paths:
         unit_indices_to_keep = np.where(spikes_per_unit >= min_spikes_per_unit)[0]
         sorting_end = sorting_end.select_units(sorting_end.unit_ids[unit_indices_to_keep])
 
-        # NWB Streaming is not working well with parallel pre=processing so we ave
-        folder_path = Path.cwd() / "build" / "local_copy"
-        folder_path.mkdir(exist_ok=True, parents=True)
-
-        if verbose:
-            print("Saving Recording")
-            print(recording)
-            start_time = time.time()
-
-        recording = recording.save_to_folder(
-            folder=folder_path,
-            overwrite=True,
-            n_jobs=8,
-            chunk_memory="1Gi",
-            verbose=True,
-            progress_bar=True,
+        sessions.append(
+            dict(
+                eid=eid,
+                dataset_name=dataset_name,
+                recording=recording,
+                sorting=sorting_end,
+                probe_info=probe_info,
+            )
         )
 
-        if verbose:
-            end_time = time.time()
-            execution_time = end_time - start_time
-            print(f"Execution time: {execution_time/60.0: 2.2f} minutes")
+    return sessions
 
-        pre_processed_recording = common_reference(
-            highpass_filter(phase_shift(astype(recording=recording, dtype="float32")), freq_min=1.0)
-        )
 
-        analyzer = create_sorting_analyzer(sorting_end, pre_processed_recording, sparse=False, folder=f"analyzer_{eid}")
-
-        random_spike_parameters = {
-            "method": "all",
-        }
-
-        # Correct for round mismatches in the number of temporal samples in conversion from seconds to samples
-        target_ms_before = 3.0
-        target_ms_after = 5.0
-        expected_fs = 30_000
-        target_nbefore = int(target_ms_before / 1000 * expected_fs)
-        target_nafter = int(target_ms_after / 1000 * expected_fs)
-        ms_before_corrected = target_nbefore / recording.sampling_frequency * 1000
-        ms_after_corrected = target_nafter / recording.sampling_frequency * 1000
-
-        template_extension_parameters = {
-            "ms_before": ms_before_corrected,
-            "ms_after": ms_after_corrected,
-            "operators": ["average"],
-        }
-
-        noise_level_parameters = {
-            "chunk_size": 10_000,
-            "num_chunks_per_segment": 20,
-        }
-
-        extensions = {
-            "random_spikes": random_spike_parameters,
-            "templates": template_extension_parameters,
-            "noise_levels": noise_level_parameters,
-        }
+def download_session(session, folder_path, verbose=True, mp_context=None):
+    """Saves a local copy of the session recording to `folder_path`.
 
-        if verbose:
-            print("Computing extensions")
-            start_time = time.time()
-
-        analyzer.compute_several_extensions(
-            extensions=extensions,
-            n_jobs=8,
-            verbose=True,
-            progress_bar=True,
-            chunk_memory="250Mi",
-        )
+    `mp_context` is the multiprocessing start method of the job processes (e.g. "spawn"), None for the default.
+    """
+    # NWB Streaming is not working well with parallel pre=processing so we ave
+    folder_path = Path(folder_path)
+    folder_path.parent.mkdir(exist_ok=True, parents=True)
 
-        if verbose:
-            end_time = time.time()
-            execution_time = end_time - start_time
-            print(f"Execution time: {execution_time/60.0: 2.2f} minutes")
+    recording = session["recording"]
+    if verbose:
+        print("Saving Recording")
+        print(recording)
+        start_time = time.time()
+
+    session["recording"] = recording.save_to_folder(
+        folder=folder_path,
+        overwrite=True,
+        n_jobs=8,
+        mp_context=mp_context,
+        chunk_memory="1Gi",
+        verbose=True,
+        progress_bar=True,
+    )
 
-        noise_level_extension = analyzer.get_extension("noise_levels")
-        noise_level_data = noise_level_extension.get_data()
+    if verbose:
+        end_time = time.time()
+        execution_time = end_time - start_time
+        print(f"Execution time: {execution_time/60.0: 2.2f} minutes")
 
-        templates_extension = analyzer.get_extension("templates")
-        templates_extension_data = templates_extension.get_data(outputs="Templates")
+    return session
 
-        # Do a check for the expected shape of the templates
-        number_of_units = sorting.get_num_units()
-        number_of_temporal_samples = target_nbefore + target_nafter
-        number_of_channels = pre_processed_recording.get_num_channels()
-        expected_shape = (number_of_units, number_of_temporal_samples, number_of_channels)
-        assert templates_extension_data.templates_array.shape == expected_shape
 
-        # TODO: check for weird shapes
-        templates_extension = analyzer.get_extension("templates")
-        templates_object = templates_extension.get_data(outputs="Templates")
-        unit_ids = templates_object.unit_ids
-        best_channel_index = find_channels_with_max_peak_to_peak_vectorized(templates_object.templates_array)
+def compute_session(session, analyzer_folder, verbose=True, mp_context=None):
+    """Computes the templates and noise levels of a session from its local recording copy.
 
-        templates_object.probe.model_name = probe_info[0]["model_name"]
-        templates_object.probe.manufacturer = probe_info[0]["manufacturer"]
-        templates_object.probe.serial_number = probe_info[0]["serial_number"]
+    The sorting analyzer is saved to `analyzer_folder`, which must be specific to the dataset (the probes of a
+    session share the same eid), and is kept until `remove_analyzer` is called once the dataset is uploaded.
+    `mp_context` is the multiprocessing start method of the job processes, as in `download_session`.
+    """
+    recording = session["recording"]
+    sorting_end = session["sorting"]
+    probe_info = session["probe_info"]
 
-        if verbose:
-            print("Saving data to Zarr")
-            print(f"{dataset_name=}")
+    pre_processed_recording = common_reference(
+        highpass_filter(phase_shift(astype(recording=recording, dtype="float32")), freq_min=1.0)
+    )
 
-        if upload_data:
-            # Create a S3 file system object with explicit credentials
-            s3_kwargs = dict(
-                anon=False, key=aws_access_key_id, secret=aws_secret_access_key, client_kwargs=client_kwargs
-            )
-            s3 = s3fs.S3FileSystem(**s3_kwargs)
+    session["analyzer_folder"] = Path(analyzer_folder)
+    analyzer = create_sorting_analyzer(
+        sorting_end, pre_processed_recording, sparse=False, folder=analyzer_folder, overwrite=True
+    )
 
-            # Specify the S3 bucket and path
-            s3_path = f"{bucket_name}/{dataset_name}"
-            store = s3fs.S3Map(root=s3_path, s3=s3)
-        else:
-            folder_path = Path.cwd() / "build" / f"{dataset_name}"
-            folder_path.mkdir(exist_ok=True, parents=True)
-            store = zarr.DirectoryStore(str(folder_path))
-
-        # Save results to Zarr
-        zarr_group = zarr.group(store=store, overwrite=True)
-        brain_area = sorting_end.get_property("brain_area")
-        zarr_group.create_dataset(name="brain_area", data=brain_area, object_codec=numcodecs.VLenUTF8())
-        spikes_per_unit = sorting_end.count_num_spikes_per_unit(outputs="array")
-        zarr_group.create_dataset(name="spikes_per_unit", data=spikes_per_unit, chunks=None, dtype="uint32")
-        zarr_group.create_dataset(
-            name="best_channel_index",
-            data=best_channel_index,
-            chunks=None,
-            dtype="uint32",
-        )
-        peak_to_peak = np.ptp(templates_extension_data.templates_array, axis=1)
-        zarr_group.create_dataset(name="peak_to_peak", data=peak_to_peak)
-        zarr_group.create_dataset(
-            name="channel_noise_levels",
-            data=noise_level_data,
-            chunks=None,
-            dtype="float32",
-        )
-        # Now you can create a Zarr array using this store
-        templates_extension_data.add_templates_to_zarr_group(zarr_group=zarr_group)
-        zarr_group_s3 = zarr_group
-        zarr.consolidate_metadata(zarr_group_s3.store)
+    random_spike_parameters = {
+        "method": "all",
+    }
+
+    # Correct for round mismatches in the number of temporal samples in conversion from seconds to samples
+    target_ms_before = 3.0
+    target_ms_after = 5.0
+    expected_fs = 30_000
+    target_nbefore = int(target_ms_before / 1000 * expected_fs)
+    target_nafter = int(target_ms_after / 1000 * expected_fs)
+    ms_before_corrected = target_nbefore / recording.sampling_frequency * 1000
+    ms_after_corrected = target_nafter / recording.sampling_frequency * 1000
+
+    template_extension_parameters = {
+        "ms_before": ms_before_corrected,
+        "ms_after": ms_after_corrected,
+        "operators": ["average"],
+    }
+
+    noise_level_parameters = {
+        "chunk_size": 10_000,
+        "num_chunks_per_segment": 20,
+    }
+
+    extensions = {
+        "random_spikes": random_spike_parameters,
+        "templates": template_extension_parameters,
+        "noise_levels": noise_level_parameters,
+    }
+
+    if verbose:
+        print("Computing extensions")
+        start_time = time.time()
+
+    analyzer.compute_several_extensions(
+        extensions=extensions,
+        n_jobs=8,
+        mp_context=mp_context,
+        verbose=True,
+        progress_bar=True,
+        chunk_memory="250Mi",
+    )
+
+    if verbose:
+        end_time = time.time()
+        execution_time = end_time - start_time
+        print(f"Execution time: {execution_time/60.0: 2.2f} minutes")
+
+    noise_level_extension = analyzer.get_extension("noise_levels")
+    noise_level_data = noise_level_extension.get_data()
+
+    templates_extension = analyzer.get_extension("templates")
+    templates_extension_data = templates_extension.get_data(outputs="Templates")
+
+    # Do a check for the expected shape of the templates
+    number_of_units = sorting_end.get_num_units()
+    number_of_temporal_samples = target_nbefore + target_nafter
+    number_of_channels = pre_processed_recording.get_num_channels()
+    expected_shape = (number_of_units, number_of_temporal_samples, number_of_channels)
+    assert templates_extension_data.templates_array.shape == expected_shape
+
+    # TODO: check for weird shapes
+    best_channel_index = find_channels_with_max_peak_to_peak_vectorized(templates_extension_data.templates_array)
+
+    templates_extension_data.probe.model_name = probe_info[0]["model_name"]
+    templates_extension_data.probe.manufacturer = probe_info[0]["manufacturer"]
+    templates_extension_data.probe.serial_number = probe_info[0]["serial_number"]
+
+    session["templates"] = templates_extension_data
+    session["noise_levels"] = noise_level_data
+    session["best_channel_index"] = best_channel_index
+    return session
+
+
+def remove_analyzer(session):
+    """Deletes the sorting analyzer folder of a session, if any."""
+    analyzer_folder = session.pop("analyzer_folder", None)
+    if analyzer_folder is not None:
+        shutil.rmtree(analyzer_folder, ignore_errors=True)
+
+
+def get_analyzer_folder(folder_path, session):
+    """Returns the sorting analyzer folder of a session, next to the local copies in `folder_path`."""
+    return Path(folder_path) / f"{Path(session['dataset_name']).stem}_analyzer"
+
+
+def upload_session(session, upload_data=True, verbose=True, sharded=False, units_per_shard=64):
+    """Saves the templates and unit properties of a session to Zarr, on S3 if `upload_data` is True.
+
+    With `sharded=True`, the dataset is written in the sharded layout (see `shard_datasets.py`).
+    """
+    dataset_name = session["dataset_name"]
+    sorting_end = session["sorting"]
+    templates_extension_data = session["templates"]
+    best_channel_index = session["best_channel_index"]
+    noise_level_data = session["noise_levels"]
+
+    if verbose:
+        print("Saving data to Zarr")
+        print(f"{dataset_name=}")
+
+    if upload_data:
+        # Shared store of the template database (AWS credentials are read from the environment)
+        store = get_backend().get_object_store(dataset_name)
+    else:
+        store = LocalBackend(Path.cwd() / "build").get_object_store(dataset_name)
+
+    # Save results to Zarr in memory, then only transmit the chunks that changed since the last upload
+    staging_store = {}
+    zarr_group = create_staging_group(staging_store)
+    brain_area = sorting_end.get_property("brain_area")
+    add_array(zarr_group, "brain_area", brain_area)
+    spikes_per_unit = sorting_end.count_num_spikes_per_unit(outputs="array")
+    add_array(zarr_group, "spikes_per_unit", spikes_per_unit, dtype="uint32")
+    add_array(zarr_group, "best_channel_index", best_channel_index, dtype="uint32")
+    peak_to_peak = np.ptp(templates_extension_data.templates_array, axis=1)
+    add_array(zarr_group, "peak_to_peak", peak_to_peak)
+    add_array(zarr_group, "channel_noise_levels", noise_level_data, dtype="float32")
+    # Now you can create a Zarr array using this store
+    templates_extension_data.add_templates_to_zarr_group(zarr_group=zarr_group)
+    zarr.consolidate_metadata(zarr_group.store)
+    if sharded:
+        staging_store = encode_sharded_staging_store(staging_store, units_per_shard=units_per_shard)
+    session["upload_summary"] = sync_store(staging_store, store, verbose=verbose)
+    return session
+
+
+def upload_ibl_templates(
+    upload_data=True,
+    overwrite=False,
+    do_testing_data=False,
+    verbose=True,
+    pipelined=False,
+    num_download_workers=1,
+    num_compute_workers=1,
+    num_upload_workers=1,
+    min_free_disk_gb=20,
+    max_local_copies_gb=None,
+    sharded=False,
+    units_per_shard=64,
+):
+    """
+    Constructs the templates of all IBL sessions in the dandiset and saves them to Zarr (see module docstring).
+
+    By default sessions are processed one after the other. With `pipelined=True`, the resolve, download, compute
+    and upload stages of different sessions run concurrently, with the given number of workers per stage.
+    Each session then gets its own local copy, which is deleted once its templates are computed, and downloads
+    wait while the local copies would leave less than `min_free_disk_gb` free on disk or exceed
+    `max_local_copies_gb` in total. The sorting analyzer of each dataset is saved next to the local copies
+    (in "build/local_copy") and deleted once the dataset is uploaded. The job processes of the download and compute
+    stages are started with the "spawn" method, as forking from the pipeline threads is not safe.
+
+    With `sharded=True`, datasets are written in the sharded layout with `units_per_shard` units per shard.
+    """
+    one_instance = get_one_instance()
+
+    client = DandiAPIClient.for_dandi_instance("dandi")
+    dandiset = client.get_dandiset(dandiset_id)
+    dandiset_paths = get_dandiset_paths(dandiset, do_testing_data=do_testing_data)
+
+    # Load already processed datasets
+    zarr_datasets = get_backend().list_datasets()
+    if verbose:
+        print(f"Found {len(zarr_datasets)} datasets already processed")
+
+    folder_path = Path.cwd() / "build" / "local_copy"
+    resolve_kwargs = dict(overwrite=overwrite, do_testing_data=do_testing_data, verbose=verbose)
+    upload_kwargs = dict(upload_data=upload_data, verbose=verbose, sharded=sharded, units_per_shard=units_per_shard)
+    if not pipelined:
+        for asset_path in dandiset_paths:
+            sessions = resolve_sessions(asset_path, dandiset, one_instance, zarr_datasets, **resolve_kwargs)
+            for session in sessions:
+                download_session(session, folder_path, verbose=verbose)
+                try:
+                    compute_session(session, get_analyzer_folder(folder_path, session), verbose=verbose)
+                    upload_session(session, **upload_kwargs)
+                finally:
+                    remove_analyzer(session)
+        return
+
+    # Job processes are started from the pipeline threads, while other threads may hold h5py, remfile or boto locks:
+    # forked children could inherit a held lock and hang, so they are spawned instead
+    mp_context = "spawn"
+    max_cache_bytes = int(max_local_copies_gb * 1024**3) if max_local_copies_gb is not None else None
+    disk_space_gate = DiskSpaceGate(
+        folder_path, min_free_bytes=int(min_free_disk_gb * 1024**3), max_cache_bytes=max_cache_bytes
+    )
+
+    def download_stage(session):
+        recording = session["recording"]
+        local_copy_bytes = recording.get_num_samples() * recording.get_num_channels() * recording.get_dtype().itemsize
+        disk_space_gate.acquire(local_copy_bytes)
+        session["local_copy_folder"] = folder_path / Path(session["dataset_name"]).stem
+        session["local_copy_bytes"] = local_copy_bytes
+        try:
+            download_session(session, session["local_copy_folder"], verbose=verbose, mp_context=mp_context)
+        except Exception:
+            release_local_copy(session)
+            raise
+        finally:
+            disk_space_gate.mark_written(local_copy_bytes)
+        return session
+
+    def compute_stage(session):
+        try:
+            compute_session(session, get_analyzer_folder(folder_path, session), verbose=verbose, mp_context=mp_context)
+        except Exception:
+            remove_analyzer(session)
+            raise
+        finally:
+            release_local_copy(session)
+        return session
+
+    def upload_stage(session):
+        try:
+            return upload_session(session, **upload_kwargs)
+        finally:
+            remove_analyzer(session)
+
+    def release_local_copy(session):
+        shutil.rmtree(session["local_copy_folder"], ignore_errors=True)
+        disk_space_gate.release(session["local_copy_bytes"])
+        session["recording"] = None
+
+    stages = [
+        dict(
+            name="resolve",
+            func=lambda asset_path: resolve_sessions(asset_path, dandiset, one_instance, zarr_datasets, **resolve_kwargs),
+            expand=True,
+        ),
+        dict(name="download", func=download_stage, num_workers=num_download_workers),
+        dict(name="compute", func=compute_stage, num_workers=num_compute_workers),
+        dict(name="upload", func=upload_stage, num_workers=num_upload_workers),
+    ]
+    sessions, failures = run_pipeline(dandiset_paths, stages, verbose=verbose)
+    if verbose:
+        print(f"Processed {len(sessions)} sessions, {len(failures)} failed")
+        for failure in failures:
+            print(f"\t{failure['stage']} failed: {failure['error']!r}")
+
+
+if __name__ == "__main__":
+    upload_ibl_templates(
+        upload_data=upload_data,
+        overwrite=overwite,
+        do_testing_data=do_testing_data,
+        verbose=verbose,
+        pipelined=pipelined,
+        num_download_workers=num_download_workers,
+        num_compute_workers=num_compute_workers,
+        num_upload_workers=num_upload_workers,
+        min_free_disk_gb=min_free_disk_gb,
+        max_local_copies_gb=max_local_copies_gb,
+        sharded=sharded,
+        units_per_shard=units_per_shard,
+    )
@@ -2,22 +2,19 @@
 This script constructs and uploads the templates from the Neuropixels Ultra dataset
 form Steinmetz and Ye, 2022. The dataset is hosted on Figshare at https://doi.org/10.6084/m9.figshare.19493588.v2
 
-Since the templates in the dataset have rather short cut outs, which might negatively interfere with 
+Since the templates in the dataset have rather short cut outs, which might negatively interfere with
 hybrid spike injections, the templates are padded and smoothed using the `MEArec` package so that they
 end up having 240 samples (90 before, 150 after the peak).
 
-Once the templates are constructed they are saved to a Zarr file which is then uploaded to 
+Once the templates are constructed they are saved to a Zarr file which is then uploaded to
 "spikeinterface-template-database" bucket (hosted by CatalystNeuro).
 """
 
 from pathlib import Path
 
 import numpy as np
-import s3fs
 import zarr
 import pandas as pd
-import os
-import numcodecs
 from tqdm.auto import tqdm
 
 import probeinterface as pi
@@ -25,6 +22,11 @@ import spikeinterface as si
 
 from MEArec.tools import pad_templates, sigmoid
 
+from incremental_upload import sync_store
+from shard_datasets import encode_sharded_staging_store
+from zarr_utils import add_array, create_staging_group
+from storage import LocalBackend, get_backend
+
 
 def smooth_edges(templates, pad_samples, smooth_percent=0.5, smooth_strength=1):
     # smooth edges
@@ -46,133 +48,132 @@ num_templates_per_dataset = 100
 target_nbefore = 90
 target_nafter = 150
 upload_data = False
+sharded = False  # Write datasets in the sharded (Zarr v3) layout
+units_per_shard = 64
 
 npultra_templates_path = Path("/home/alessio/Documents/Data/Templates/NPUltraWaveforms/")
 dataset_stem = "steinmetz_ye_np_ultra_2022_figshare19493588v2"
 
-# AWS credentials
-aws_access_key_id = os.environ.get("AWS_ACCESS_KEY_ID")
-aws_secret_access_key = os.environ.get("AWS_SECRET_ACCESS_KEY")
-bucket_name = "spikeinterface-template-database"
-client_kwargs = {"region_name": "us-east-2"}
-
-# Load the templates and the required metadata
-xpos = np.load(npultra_templates_path / "channels.xcoords.npy")
-ypos = np.load(npultra_templates_path / "channels.ycoords.npy")
-
-channel_locations = np.squeeze([xpos, ypos]).T
-
-templates_array = np.load(npultra_templates_path / "clusters.waveforms.npy")
-spike_clusters = np.load(npultra_templates_path / "spikes.clusters.npy")
-
-brain_area = pd.read_csv(npultra_templates_path / "clusters.acronym.tsv", sep="\t")
-brain_area_acronym = brain_area["acronym"].values
-
-# Instantiate Probe
-probe = pi.Probe(ndim=2)
-probe.set_contacts(positions=channel_locations, shapes="square", shape_params={"width": 5})
-probe.model_name = "Neuropixels Ultra"
-probe.manufacturer = "IMEC"
-
-# Unit ids and properties
-unit_ids, spikes_per_unit = np.unique(spike_clusters, return_counts=True)
-unit_ids_enough_spikes = spikes_per_unit >= min_spikes_per_unit
-unit_ids = unit_ids[unit_ids_enough_spikes]
-spikes_per_unit = spikes_per_unit[unit_ids_enough_spikes]
-
-# Sort the units by unit_id
-sort_unit_indices = np.argsort(unit_ids)
-unit_ids = unit_ids[sort_unit_indices].astype(int)
-spikes_per_unit = spikes_per_unit[sort_unit_indices]
-brain_area_acronym = brain_area_acronym[sort_unit_indices]
-
-# Process the templates to make them smooth
-nbefore = 40
-sampling_frequency = 30000
-num_samples = templates_array.shape[1]
-nafter = num_samples - nbefore
-
-pad_samples = [target_nbefore - nbefore, target_nafter - nafter]
-
-# MEArec needs swap axes
-print("Padding and smoothing templates")
-templates_array_swap = templates_array.swapaxes(1, 2)
-tmp_templates_file = "templates_padded.raw"
-templates_padded_swap = pad_templates(
-    templates_array_swap,
-    pad_samples,
-    drifting=False,
-    dtype="float",
-    verbose=False,
-    n_jobs=-1,
-    tmp_file=tmp_templates_file,
-    parallel=True,
-)
-templates_padded = templates_padded_swap.swapaxes(1, 2)
-Path(tmp_templates_file).unlink()
-
-# smooth edges
-templates_smoothed_swap = smooth_edges(templates_padded_swap, pad_samples)
-templates_smoothed = templates_smoothed_swap.swapaxes(1, 2)
-
-# Create Templates object
-print("Creating Templates object")
-templates_ultra = si.Templates(
-    templates_array=templates_smoothed,
-    sampling_frequency=sampling_frequency,
-    nbefore=target_nbefore,
-    unit_ids=unit_ids,
-    probe=probe,
-    is_scaled=True,
-)
-print(f"Full templates: {templates_ultra}")
-
-split_indices = np.arange(0, len(unit_ids), num_templates_per_dataset)
-
-for i in tqdm(np.arange(len(split_indices)), desc="Uploading dataset in chunks"):
-    index = split_indices[i]
-    if i < len(split_indices) - 1:
-        s = slice(index, split_indices[i + 1])
-    else:
-        s = slice(index, len(unit_ids))
-    unit_ids_split = unit_ids[s]
-    brain_area_split = brain_area_acronym[s]
-    spikes_per_unit_split = spikes_per_unit[s]
-
-    templates_split = templates_ultra.select_units(unit_ids_split)
-    print(f"Creating dataset {i} with {len(unit_ids_split)} units")
-    dataset_name = f"{dataset_stem}_{i}.zarr"
-
-    best_channel_index = si.get_template_extremum_channel(templates_split, mode="peak_to_peak", outputs="index")
-    best_channel_index = list(best_channel_index.values())
-
-    if upload_data:
-        # Create a S3 file system object with explicit credentials
-        s3_kwargs = dict(anon=False, key=aws_access_key_id, secret=aws_secret_access_key, client_kwargs=client_kwargs)
-        s3 = s3fs.S3FileSystem(**s3_kwargs)
-
-        # Specify the S3 bucket and path
-        s3_path = f"{bucket_name}/{dataset_name}"
-        store = s3fs.S3Map(root=s3_path, s3=s3)
-    else:
-        folder_path = Path.cwd() / "build" / f"{dataset_name}"
-        folder_path.mkdir(exist_ok=True, parents=True)
-        store = zarr.DirectoryStore(str(folder_path))
-
-    # Save results to Zarr
-    zarr_group = zarr.group(store=store, overwrite=True)
-    zarr_group.create_dataset(name="brain_area", data=brain_area_split, object_codec=numcodecs.VLenUTF8())
-    zarr_group.create_dataset(name="spikes_per_unit", data=spikes_per_unit_split, chunks=None, dtype="uint32")
-    zarr_group.create_dataset(
-        name="best_channel_index",
-        data=best_channel_index,
-        chunks=None,
-        dtype="uint32",
+
+def upload_npultra_templates(npultra_templates_path, upload_data=False, sharded=False, units_per_shard=64):
+    """Constructs the NP Ultra templates from the Figshare files in `npultra_templates_path` and saves them to Zarr.
+
+    With `sharded=True`, datasets are written in the sharded layout (see `shard_datasets.py`).
+    """
+    npultra_templates_path = Path(npultra_templates_path)
+
+    # Load the templates and the required metadata
+    xpos = np.load(npultra_templates_path / "channels.xcoords.npy")
+    ypos = np.load(npultra_templates_path / "channels.ycoords.npy")
+
+    channel_locations = np.squeeze([xpos, ypos]).T
+
+    templates_array = np.load(npultra_templates_path / "clusters.waveforms.npy")
+    spike_clusters = np.load(npultra_templates_path / "spikes.clusters.npy")
+
+    brain_area = pd.read_csv(npultra_templates_path / "clusters.acronym.tsv", sep="\t")
+    brain_area_acronym = brain_area["acronym"].values
+
+    # Instantiate Probe
+    probe = pi.Probe(ndim=2)
+    probe.set_contacts(positions=channel_locations, shapes="square", shape_params={"width": 5})
+    probe.model_name = "Neuropixels Ultra"
+    probe.manufacturer = "IMEC"
+
+    # Unit ids and properties
+    unit_ids, spikes_per_unit = np.unique(spike_clusters, return_counts=True)
+    unit_ids_enough_spikes = spikes_per_unit >= min_spikes_per_unit
+    unit_ids = unit_ids[unit_ids_enough_spikes]
+    spikes_per_unit = spikes_per_unit[unit_ids_enough_spikes]
+
+    # Sort the units by unit_id
+    sort_unit_indices = np.argsort(unit_ids)
+    unit_ids = unit_ids[sort_unit_indices].astype(int)
+    spikes_per_unit = spikes_per_unit[sort_unit_indices]
+    brain_area_acronym = brain_area_acronym[sort_unit_indices]
+
+    # Process the templates to make them smooth
+    nbefore = 40
+    sampling_frequency = 30000
+    num_samples = templates_array.shape[1]
+    nafter = num_samples - nbefore
+
+    pad_samples = [target_nbefore - nbefore, target_nafter - nafter]
+
+    # MEArec needs swap axes
+    print("Padding and smoothing templates")
+    templates_array_swap = templates_array.swapaxes(1, 2)
+    tmp_templates_file = "templates_padded.raw"
+    templates_padded_swap = pad_templates(
+        templates_array_swap,
+        pad_samples,
+        drifting=False,
+        dtype="float",
+        verbose=False,
+        n_jobs=-1,
+        tmp_file=tmp_templates_file,
+        parallel=True,
     )
-    peak_to_peak = np.ptp(templates_split.templates_array, axis=1)
-    zarr_group.create_dataset(name="peak_to_peak", data=peak_to_peak)
+    templates_padded = templates_padded_swap.swapaxes(1, 2)
+    Path(tmp_templates_file).unlink()
 
-    # Now you can create a Zarr array using this store
-    templates_split.add_templates_to_zarr_group(zarr_group=zarr_group)
-    zarr_group_s3 = zarr_group
-    zarr.consolidate_metadata(zarr_group_s3.store)
+    # smooth edges
+    templates_smoothed_swap = smooth_edges(templates_padded_swap, pad_samples)
+    templates_smoothed = templates_smoothed_swap.swapaxes(1, 2)
+
+    # Create Templates object
+    print("Creating Templates object")
+    templates_ultra = si.Templates(
+        templates_array=templates_smoothed,
+        sampling_frequency=sampling_frequency,
+        nbefore=target_nbefore,
+        unit_ids=unit_ids,
+        probe=probe,
+        is_scaled=True,
+    )
+    print(f"Full templates: {templates_ultra}")
+
+    split_indices = np.arange(0, len(unit_ids), num_templates_per_dataset)
+
+    for i in tqdm(np.arange(len(split_indices)), desc="Uploading dataset in chunks"):
+        index = split_indices[i]
+        if i < len(split_indices) - 1:
+            s = slice(index, split_indices[i + 1])
+        else:
+            s = slice(index, len(unit_ids))
+        unit_ids_split = unit_ids[s]
+        brain_area_split = brain_area_acronym[s]
+        spikes_per_unit_split = spikes_per_unit[s]
+
+        templates_split = templates_ultra.select_units(unit_ids_split)
+        print(f"Creating dataset {i} with {len(unit_ids_split)} units")
+        dataset_name = f"{dataset_stem}_{i}.zarr"
+
+        best_channel_index = si.get_template_extremum_channel(templates_split, mode="peak_to_peak", outputs="index")
+        best_channel_index = list(best_channel_index.values())
+
+        if upload_data:
+            # Shared store of the template database (AWS credentials are read from the environment)
+            store = get_backend().get_object_store(dataset_name)
+        else:
+            store = LocalBackend(Path.cwd() / "build").get_object_store(dataset_name)
+
+        # Save results to Zarr in memory, then only transmit the chunks that changed since the last upload
+        staging_store = {}
+        zarr_group = create_staging_group(staging_store)
+        add_array(zarr_group, "brain_area", brain_area_split)
+        add_array(zarr_group, "spikes_per_unit", spikes_per_unit_split, dtype="uint32")
+        add_array(zarr_group, "best_channel_index", best_channel_index, dtype="uint32")
+        peak_to_peak = np.ptp(templates_split.templates_array, axis=1)
+        add_array(zarr_group, "peak_to_peak", peak_to_peak)
+
+        # Now you can create a Zarr array using this store
+        templates_split.add_templates_to_zarr_group(zarr_group=zarr_group)
+        zarr.consolidate_metadata(zarr_group.store)
+        if sharded:
+            staging_store = encode_sharded_staging_store(staging_store, units_per_shard=units_per_shard)
+        sync_store(staging_store, store, verbose=True)
+
+
+if __name__ == "__main__":
+    upload_npultra_templates(npultra_templates_path, upload_data=upload_data, sharded=sharded, units_per_shard=units_per_shard)
@@ -0,0 +1,90 @@
+"""
+Helpers to read and write the arrays of template datasets with the zarr >= 3 API.
+
+Datasets in the default layout are written with `zarr_format=2` and read by older Zarr readers (e.g. the web viewer),
+so string arrays are stored as variable-length UTF-8, as with the `numcodecs.VLenUTF8` object codec of zarr 2.
+"""
+
+import numpy as np
+import zarr
+
+
+def read_array(array) -> np.ndarray:
+    """Reads a whole array, with strings as a fixed-width unicode NumPy array."""
+    data = array[...]
+    if data.dtype.kind in ("O", "T"):
+        data = data.astype(object).astype(str)
+    return np.asarray(data)
+
+
+def add_array(zarr_group, name: str, data, dtype=None, chunks="auto", **kwargs):
+    """Adds an array to a group and writes its data.
+
+    Parameters
+    ----------
+    zarr_group : zarr.Group
+        The group to add the array to.
+    name : str
+        The array name.
+    data : array-like
+        The array data. Strings are stored as variable-length UTF-8.
+    dtype : dtype, optional
+        The dtype of the stored array. Defaults to the dtype of `data`.
+    chunks : tuple or "auto", default: "auto"
+        The chunk shape.
+    **kwargs
+        Other arguments of `zarr.Group.create_array` (e.g. `shards`, `compressors` or `attributes`).
+
+    Returns
+    -------
+    array : zarr.Array
+        The new array.
+    """
+    data = np.asarray(data)
+    if data.dtype.kind in ("U", "O", "T"):
+        data = data.astype(str)
+        dtype = str
+    dtype = data.dtype if dtype is None else dtype
+    array = zarr_group.create_array(name, shape=data.shape, dtype=dtype, chunks=chunks, **kwargs)
+    array[...] = data
+    return array
+
+
+def create_staging_group(staging_store: dict):
+    """Creates an empty dataset in the default layout in an in-memory staging store (see `incremental_upload`)."""
+    return zarr.group(store=staging_store, overwrite=True, zarr_format=2)
+
+
+def rewrite_array(zarr_group, name: str, data):
+    """Replaces an array of a group with new data (e.g. a subset of its units), keeping its encoding.
+
+    Assigning `zarr_group[name] = data` would recreate the array with the default chunks and codecs, which, for example,
+    turns a sharded array back into one object per chunk. The new array keeps the chunks, shards, codecs, fill value and
+    attributes of the original one.
+
+    Parameters
+    ----------
+    zarr_group : zarr.Group
+        The group of the array, opened in a writable mode.
+    name : str
+        The array name.
+    data : array-like
+        The new array data.
+
+    Returns
+    -------
+    array : zarr.Array
+        The new array.
+    """
+    original = zarr_group[name]
+    encoding = dict(
+        chunks=original.chunks,
+        shards=original.shards,
+        filters=original.filters,
+        compressors=original.compressors,
+        fill_value=original.fill_value,
+        attributes=original.attrs.asdict(),
+    )
+    if original.metadata.zarr_format == 3:
+        encoding.update(serializer=original.serializer, dimension_names=original.metadata.dimension_names)
+    return add_array(zarr_group, name, data, dtype=original.dtype, overwrite=True, **encoding)
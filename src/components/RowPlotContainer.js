@@ -4,75 +4,53 @@ import SingleTemplatePlot from "./SingleTemplatePlot";
 import ProbePlot from "./ProbePlot";
 import DataTablePlot from "./DataTablePlot";
 
-import { openGroup } from "zarr";
-import calculatePeakToPeakValues from "../utils/CalculationUtils";
-import { percentageToFilterChannels } from "../styles/StyleConstants";
+import { fetchPreviewUnit } from "../utils/PreviewUtils";
 
 
-const RowPlotContainer = ({ templateIndex, storeRef, dataDictionary, isSelected, toggleSelection }) => {
+const RowPlotContainer = ({ templateIndex, previewUrl, previewHeader, isSelected, toggleSelection }) => {
   const [isLoading, setIsLoading] = useState(true);
   const [probeXCoordinates, setProbeXCoordinates] = useState([]);
   const [probeYCoordinates, setProbeYCoordinates] = useState([]);
   const [location, setLocation] = useState([0, 0]);
   const [samplingFrequency, setSamplingFrequency] = useState(null);
+  const [bestChannel, setBestChannel] = useState(null);
   const [activeIndices, setActiveIndices] = useState([]);
-  const [templateArray, setTemplateArray] = useState([]);
+  const [waveforms, setWaveforms] = useState([]);
   const [tableData, setTableData] = useState([]);
 
   useEffect(() => {
     const loadData = async () => {
-      try {
-
-        const zarrGroup = await openGroup(storeRef);
-        const probeGroup = await openGroup(storeRef, "probe", "r");
+      if (!previewHeader) return; // Exit early until the sidecar header is loaded
 
-        // Fetch sampling frequency
-        const attributes = await zarrGroup.attrs.asObject();
-        setSamplingFrequency(attributes["sampling_frequency"]);
+      try {
+        // One ranged GET of the unit record: active channels are already selected (see python/preview_sidecar.py)
+        const unit = await fetchPreviewUnit(previewUrl, previewHeader, templateIndex);
+        setSamplingFrequency(unit.samplingFrequency);
+        setBestChannel(unit.bestChannel);
+        setActiveIndices(unit.activeChannels);
+        setWaveforms(unit.waveforms);
 
         // Fetch probe data
-        const xCoords = await probeGroup.getItem("x").then((data) => data.get(null));
-        const yCoords = await probeGroup.getItem("y").then((data) => data.get(null));
-        setProbeXCoordinates(xCoords.data);
-        setProbeYCoordinates(yCoords.data);
-
-        // Fetch template data for a specific index
-        const templateArray = await zarrGroup.getItem("templates_array");
-        setTemplateArray(templateArray);
-        const singleTemplate = await templateArray.get([templateIndex, null, null]);
-        
-        const peakToPeakValues = calculatePeakToPeakValues(singleTemplate);
-        const bestChannel = peakToPeakValues.indexOf(Math.max(...peakToPeakValues));
-
-        // Active indices calculation
-        const _activeIndices = peakToPeakValues
-          .map((value, index) => (value >= peakToPeakValues[bestChannel] * percentageToFilterChannels ? index : null))
-          .filter((index) => index !== null);
-        setActiveIndices(_activeIndices);
+        const { xCoordinates, yCoordinates } = previewHeader.channelLayouts[unit.layoutIndex];
+        setProbeXCoordinates(xCoordinates);
+        setProbeYCoordinates(yCoordinates);
 
         // Set location based on best channel
-        const locationX = xCoords.data[bestChannel];
-        const locationY = yCoords.data[bestChannel];
+        const locationX = xCoordinates[unit.bestChannel];
+        const locationY = yCoordinates[unit.bestChannel];
         setLocation([locationX, locationY]);
 
-        // Set table data (mockup or real)
-        const brainArea = dataDictionary["brain_area"][templateIndex];
-        const NumberOfSpikes = dataDictionary["spikes_per_unit"][templateIndex]
-        const bestChannelID = dataDictionary["channel_ids"][bestChannel]
-        const UnitID = dataDictionary["unit_ids"][templateIndex]
-
-        const peakToPeakBestChannel = peakToPeakValues[bestChannel]
-        const peakToPeakBestChannelDecimalsRounded = peakToPeakBestChannel.toFixed(2)
+        const peakToPeakBestChannelDecimalsRounded = unit.amplitudeUV.toFixed(2);
 
         const data = [
           // { attribute: "Template Index", value: templateIndex},
           // { attribute: "Channel with max amplitude", value: bestChannel },
-          { attribute: "UnitID", value: UnitID },
-          { attribute: "Number of Spikes", value: NumberOfSpikes },
-          { attribute: "Best ChannelID", value: bestChannelID},
-          { attribute: "Brain Location", value: brainArea},
+          { attribute: "UnitID", value: unit.unitId },
+          { attribute: "Number of Spikes", value: unit.spikesPerUnit },
+          { attribute: "Best ChannelID", value: unit.bestChannelId},
+          { attribute: "Brain Location", value: unit.brainArea},
           { attribute: "Peak To Peak (uV)", value: peakToPeakBestChannelDecimalsRounded},
-          { attribute: "Depth (um)", value: location[1]},
+          { attribute: "Depth (um)", value: locationY},
 
         ];
         setTableData(data);
@@ -85,7 +63,7 @@ const RowPlotContainer = ({ templateIndex, storeRef, dataDictionary, isSelected,
     };
 
     loadData();
-  }, [templateIndex, storeRef]); // Dependency array to ensure re-fetching when these values change
+  }, [templateIndex, previewUrl, previewHeader]); // Dependency array to ensure re-fetching when these values change
 
   if (isLoading) {
     return <div>Loading data for template {templateIndex}...</div>;
@@ -101,9 +79,8 @@ const RowPlotContainer = ({ templateIndex, storeRef, dataDictionary, isSelected,
       <div className="template-plot">
         <SingleTemplatePlot
           templateIndex={templateIndex}
-          templateArray={templateArray}
-          probeXCoordinates={probeXCoordinates}
-          probeYCoordinates={probeYCoordinates}
+          waveforms={waveforms}
+          bestChannel={bestChannel}
           activeIndices={activeIndices}
           samplingFrequency={samplingFrequency}
         />
@@ -1,20 +1,17 @@
 import { bestChannelColor, activeChannelsColor, plotFont} from "../styles/StyleConstants";
-import calculatePeakToPeakValues from "../utils/CalculationUtils";
 import React, { useEffect } from "react";
 import Plot from "plotly.js-dist";
 
-function SingleTemplatePlot({ templateIndex, templateArray, samplingFrequency, activeIndices }) {
+function SingleTemplatePlot({ templateIndex, waveforms, bestChannel, samplingFrequency, activeIndices }) {
   useEffect(() => {
     const loadPlotData = async () => {
-      if (!templateArray) return; // Exit early if templateArray is not available
+      if (waveforms.length === 0) return; // Exit early if the waveforms are not available
 
       try {
-        const singleTemplate = await templateArray.get([templateIndex, null, null]);
-        const peak_to_peak_values = calculatePeakToPeakValues(singleTemplate);
-        const bestChannel = peak_to_peak_values.indexOf(Math.max(...peak_to_peak_values));
-        const singleTemplateBestChannel = await singleTemplate.get([null, bestChannel]);
+        // One waveform per active channel, in the order of activeIndices (which includes the best channel)
+        const singleTemplateBestChannel = waveforms[activeIndices.indexOf(bestChannel)];
 
-        const numberOfSamples = singleTemplate.shape[0];
+        const numberOfSamples = singleTemplateBestChannel.length;
         const xData = Array.from({ length: numberOfSamples }, (_, i) => i);
         const timeMilliseconds = xData.map((value) => (value / samplingFrequency) * 1000.0);
 
@@ -23,7 +20,7 @@ function SingleTemplatePlot({ templateIndex, templateArray, samplingFrequency, a
 
         plotData.push({
           x: timeMilliseconds,
-          y: singleTemplateBestChannel.data,
+          y: singleTemplateBestChannel,
           type: "scatter",
           mode: "lines",
           line: {
@@ -36,10 +33,10 @@ function SingleTemplatePlot({ templateIndex, templateArray, samplingFrequency, a
         });
 
         const firstActiveChannelIndex = activeIndices[0];
-        activeIndices.forEach((channelIndex) => {
+        activeIndices.forEach((channelIndex, activeIndex) => {
           plotData.push({
             x: timeMilliseconds,
-            y: singleTemplate.get([null, channelIndex]).data,
+            y: waveforms[activeIndex],
             type: "scatter",
             mode: "lines",
             line: {
@@ -76,7 +73,7 @@ function SingleTemplatePlot({ templateIndex, templateArray, samplingFrequency, a
     };
 
     loadPlotData();
-  }, [templateIndex, templateArray, samplingFrequency, activeIndices]); // Updated dependency array
+  }, [templateIndex, waveforms, bestChannel, samplingFrequency, activeIndices]); // Updated dependency array
 
   return <div id={`plotDiv${templateIndex}`}></div>;
 }
@@ -5,4 +5,3 @@ export const plotFont = {
   size: 12,
   color: "#7f7f7f",
 };
-export const percentageToFilterChannels = 0.1;
@@ -0,0 +1,104 @@
+// Reader for the preview sidecars written by python/preview_sidecar.py (in previews/ of the template database).
+// The header, channel layouts and unit offset table are fetched once, then each unit with one ranged GET.
+
+const PREVIEW_MAGIC = "HTLPREV\0";
+const PREVIEW_VERSION = 2;
+const HEADER_SIZE = 48;
+const OFFSET_ENTRY_SIZE = 16;
+const RECORD_HEADER_SIZE = 40;
+
+function getPreviewFileName(probe) {
+  return probe.replace(/[^A-Za-z0-9._-]+/g, "_") + ".htlp";
+}
+
+async function fetchRange(url, start, end) {
+  // `end` is exclusive
+  const response = await fetch(url, { headers: { Range: `bytes=${start}-${end - 1}` } });
+  if (!response.ok) {
+    throw new Error(`Failed to fetch ${url}: ${response.status}`);
+  }
+  const buffer = await response.arrayBuffer();
+  // Servers that ignore the Range header return the whole file
+  return response.status === 206 ? buffer : buffer.slice(start, end);
+}
+
+async function fetchPreviewHeader(url) {
+  const headerView = new DataView(await fetchRange(url, 0, HEADER_SIZE));
+  const magic = String.fromCharCode(...new Uint8Array(headerView.buffer, 0, 8));
+  if (magic !== PREVIEW_MAGIC) {
+    throw new Error(`${url} is not a template preview sidecar`);
+  }
+  const version = headerView.getUint32(8, true);
+  if (version !== PREVIEW_VERSION) {
+    throw new Error(`Unsupported preview sidecar version ${version} (expected ${PREVIEW_VERSION})`);
+  }
+  const numUnits = headerView.getUint32(12, true);
+  const numLayouts = headerView.getUint32(16, true);
+  const layoutsOffset = Number(headerView.getBigUint64(24, true));
+  const offsetTableOffset = Number(headerView.getBigUint64(32, true));
+  const recordsOffset = Number(headerView.getBigUint64(40, true));
+
+  const prefix = await fetchRange(url, layoutsOffset, recordsOffset);
+  const prefixView = new DataView(prefix);
+  const channelLayouts = [];
+  let position = 0;
+  for (let i = 0; i < numLayouts; i++) {
+    const numChannels = prefixView.getUint32(position, true);
+    position += 4;
+    const xCoordinates = new Array(numChannels);
+    const yCoordinates = new Array(numChannels);
+    for (let channel = 0; channel < numChannels; channel++) {
+      xCoordinates[channel] = prefixView.getFloat32(position + 8 * channel, true);
+      yCoordinates[channel] = prefixView.getFloat32(position + 8 * channel + 4, true);
+    }
+    channelLayouts.push({ xCoordinates, yCoordinates });
+    position += 8 * numChannels;
+  }
+
+  const recordOffsets = new Array(numUnits);
+  const recordLengths = new Array(numUnits);
+  const tablePosition = offsetTableOffset - layoutsOffset;
+  for (let unit = 0; unit < numUnits; unit++) {
+    const entryPosition = tablePosition + OFFSET_ENTRY_SIZE * unit;
+    recordOffsets[unit] = Number(prefixView.getBigUint64(entryPosition, true));
+    recordLengths[unit] = prefixView.getUint32(entryPosition + 8, true);
+  }
+
+  return { version, numUnits, channelLayouts, recordOffsets, recordLengths };
+}
+
+async function fetchPreviewUnit(url, header, previewIndex) {
+  const start = header.recordOffsets[previewIndex];
+  const record = await fetchRange(url, start, start + header.recordLengths[previewIndex]);
+  const recordView = new DataView(record);
+  const numSamples = recordView.getUint32(8, true);
+  const numActiveChannels = recordView.getUint32(12, true);
+  const labelsLength = recordView.getUint32(36, true);
+
+  const labelsBytes = new Uint8Array(record, RECORD_HEADER_SIZE, labelsLength);
+  const [unitId, bestChannelId, brainArea] = new TextDecoder("utf-8").decode(labelsBytes).split("\0");
+
+  // Records and their sections are 4-byte aligned, and typed arrays use the platform byte order, which is
+  // little-endian in browsers
+  const channelsOffset = RECORD_HEADER_SIZE + labelsLength;
+  const activeChannels = Array.from(new Uint32Array(record, channelsOffset, numActiveChannels));
+  const samples = new Float32Array(record, channelsOffset + 4 * numActiveChannels, numActiveChannels * numSamples);
+  const waveforms = activeChannels.map((_, i) => Array.from(samples.subarray(i * numSamples, (i + 1) * numSamples)));
+
+  return {
+    layoutIndex: recordView.getUint32(0, true),
+    bestChannel: recordView.getUint32(4, true),
+    unitId,
+    bestChannelId,
+    brainArea,
+    spikesPerUnit: recordView.getUint32(16, true),
+    amplitudeUV: recordView.getFloat32(20, true),
+    signalToNoiseRatio: recordView.getFloat32(24, true),
+    nbefore: recordView.getUint32(28, true),
+    samplingFrequency: recordView.getFloat32(32, true),
+    activeChannels,
+    waveforms,
+  };
+}
+
+export { getPreviewFileName, fetchPreviewHeader, fetchPreviewUnit };